@@ -0,0 +1,371 @@
+"""资源提取流程的速度和内存: 生成真实格式的 Unity bundle, 依次调用提取工具的各个阶段计时
+
+python -m benchmark.bench_extract --bundles 20 --monobehaviours 2000 --text-assets 200 --fields 8 --depth 3
+
+生成的游戏目录为 Game.exe + Game_Data, MonoBehaviour 和 TextAsset 分布在 StreamingAssets 下的
+LZ4 压缩 bundle 中, MonoScript 单独放在 default_monoscripts.bundle, 需要跨 bundle 解析.
+bundle 的格式见 unity_bundle.py, --verify 会先用 UnityPy 读取一遍检查生成结果.
+
+各阶段调用的代码:
+    discovery             iter_asset_files, 与 get_all_files 相同
+    extract               TextFinder.load_assets_script_obj, 单进程全部导出
+                          (load_asset_bundle + iter_monobehaviour/dump_script_obj)
+    extract-sharded       TextFinder.load_assets_script_obj(workers=N)
+    extract-incremental   重新生成一个 bundle 后增量导出
+    search                TextFinder.dump_prepare_text (iter_script_obj_text)
+    write-back            WriteMonoBehaviour.write_cache_to_file, 包括 update_monobehaviour 和重新压缩
+    repack                AssetsTools.compresses_asset_bundle, 压缩未压缩的 bundle
+
+除 discovery 外的阶段依赖 pythonnet 和 AssetsTools.NET, 无法导入时跳过这些阶段,
+search 改为搜索生成时写出的 script_obj.jsonl (与导出结果的格式相同).
+tracemalloc 只统计 Python 堆, 不包括 .NET 运行时和子进程的内存
+"""
+import time
+import random
+import shutil
+import argparse
+import tempfile
+import tracemalloc
+import ujson as json
+
+from pathlib import Path
+
+from core.UnityExtractor.AssetsTools.AssetFiles import FileType, iter_asset_files
+from core.UnityExtractor.ScriptObj import write_script_obj_record, iter_script_obj_text
+
+from .bench_translate import HIRAGANA, KANA, PUNCTUATION
+from .unity_bundle import (
+    CLASS_MONO_BEHAVIOUR,
+    CLASS_MONO_SCRIPT,
+    CLASS_TEXT_ASSET,
+    SerializedFileWriter,
+    field,
+    string_field,
+    vector_field,
+    mono_behaviour_type_tree,
+    mono_script_type_tree,
+    text_asset_type_tree,
+    mono_script_value,
+    mono_behaviour_value,
+    pack_bundle,
+)
+
+SCRIPT_NUM = 20
+# 文件名包含 monoscripts, 分片导出时会作为依赖文件加载
+SCRIPT_BUNDLE = "default_monoscripts.bundle"
+SCRIPT_CAB = "CAB-monoscripts"
+TEXT_ASSET_PATH_ID = 100000
+
+
+def japanese_text() -> str:
+    return "".join(random.choices(HIRAGANA + KANA, k=random.randint(4, 30))) + random.choice(
+        PUNCTUATION
+    )
+
+
+def ascii_text() -> str:
+    return "".join(random.choices("abcdefghijklmnopqrstuvwxyz_", k=random.randint(4, 20)))
+
+
+def make_value(fields: int, depth: int, japanese_rate: float) -> dict:
+    """每层 fields 个字符串字段, 再嵌套一个子对象和一个对象列表, 深度为 depth"""
+    value = {
+        f"field{index}": japanese_text() if random.random() < japanese_rate else ascii_text()
+        for index in range(fields)
+    }
+    if depth > 0:
+        value["child"] = make_value(fields, depth - 1, japanese_rate)
+        value["items"] = [
+            {"id": index, "text": japanese_text() if random.random() < japanese_rate else ""}
+            for index in range(random.randint(0, 4))
+        ]
+    return value
+
+
+def value_fields(fields: int, depth: int) -> list:
+    """make_value 生成的对象对应的类型树字段"""
+    nodes = [string_field(f"field{index}") for index in range(fields)]
+    if depth > 0:
+        nodes.append(field(f"Level{depth - 1}", "child", children=value_fields(fields, depth - 1)))
+        nodes.append(
+            vector_field(
+                "items", field("Item", "data", children=[field("int", "id", 4), string_field("text")])
+            )
+        )
+    return nodes
+
+
+def write_script_bundle(bundle_dir: Path):
+    writer = SerializedFileWriter()
+    type_index = writer.add_type(CLASS_MONO_SCRIPT, mono_script_type_tree())
+    for index in range(SCRIPT_NUM):
+        writer.add_object(index + 1, type_index, mono_script_value(f"Script{index}"))
+    (bundle_dir / SCRIPT_BUNDLE).write_bytes(pack_bundle([(SCRIPT_CAB, writer.to_bytes())]))
+
+
+def write_bundle(args, bundle_file: Path, bundle_index: int, records_file=None, compressed=True):
+    """生成一个 bundle, records_file 不为空时同时写入与导出结果格式相同的记录"""
+    cab_name = f"CAB-{bundle_index:032x}"
+    # 与 FieldsInfo.file_path 一样相对于游戏目录
+    file_path = str(bundle_file.relative_to(bundle_file.parents[2])) if records_file is not None else ""
+    writer = SerializedFileWriter()
+    script_file_id = writer.add_external(f"archive:/{SCRIPT_CAB}/{SCRIPT_CAB}")
+
+    def add_record(class_name: str, asset_name: str, path_id: int, value):
+        if records_file is not None:
+            write_script_obj_record(
+                records_file,
+                {
+                    "file_path": file_path,
+                    "file_name_fix": "",
+                    "is_bundle": True,
+                    "cab_name": cab_name,
+                    "class_name": class_name,
+                    "asset_name": asset_name,
+                    "container_path": "",
+                    "path_id": path_id,
+                    "value": value,
+                },
+            )
+
+    # 每个脚本一个类型, 类型树相同
+    mono_type_tree = mono_behaviour_type_tree(value_fields(args.fields, args.depth))
+    script_types = {}
+    for index in range(args.monobehaviours // args.bundles):
+        script_path_id = index % SCRIPT_NUM + 1
+        if script_path_id not in script_types:
+            script_types[script_path_id] = writer.add_type(
+                CLASS_MONO_BEHAVIOUR, mono_type_tree, (script_file_id, script_path_id)
+            )
+        value = mono_behaviour_value(
+            f"mono{index}",
+            script_file_id,
+            script_path_id,
+            make_value(args.fields, args.depth, args.japanese_rate),
+        )
+        writer.add_object(index + 1, script_types[script_path_id], value)
+        add_record(f"Script{script_path_id - 1}", f"mono{index}", index + 1, value)
+
+    text_type = writer.add_type(CLASS_TEXT_ASSET, text_asset_type_tree())
+    for index in range(args.text_assets // args.bundles):
+        # TextAsset 一半是 json 文本 (导出时会被解析成对象), 一半是纯文本
+        if index % 2:
+            value = make_value(args.fields, 1, args.japanese_rate)
+            script = json.dumps(value, ensure_ascii=False)
+        else:
+            value = script = "\n".join(japanese_text() for _ in range(args.fields))
+        path_id = TEXT_ASSET_PATH_ID + index
+        writer.add_object(path_id, text_type, {"m_Name": f"text{index}", "m_Script": script})
+        add_record("TextAsset", f"text{index}", path_id, value)
+
+    bundle_file.write_bytes(pack_bundle([(cab_name, writer.to_bytes())], compressed))
+
+
+def generate_game(args, game_dir: Path, records_file: Path) -> int:
+    """生成游戏目录, 除 bundle 外还有会被跳过的资源文件, 返回 MonoBehaviour 和 TextAsset 的数量"""
+    (game_dir / "Game.exe").write_bytes(b"MZ")
+    bundle_dir = game_dir / "Game_Data" / "StreamingAssets"
+    bundle_dir.mkdir(parents=True)
+    write_script_bundle(bundle_dir)
+    with open(records_file, "w", encoding="utf-8") as f:
+        for bundle_index in range(args.bundles):
+            write_bundle(args, bundle_dir / f"bundle{bundle_index}.bundle", bundle_index, f)
+            # 贴图数据和其他无关文件
+            (bundle_dir / f"bundle{bundle_index}.resS").write_bytes(random.randbytes(4096))
+            (bundle_dir / f"raw{bundle_index}.bytes").write_bytes(random.randbytes(4096))
+    return (args.monobehaviours // args.bundles + args.text_assets // args.bundles) * args.bundles
+
+
+def verify_game(game_dir: Path) -> int:
+    """用 UnityPy 读取生成的 bundle, 检查 MonoBehaviour 都能解析到 MonoScript"""
+    import UnityPy
+
+    env = UnityPy.load(str(game_dir / "Game_Data" / "StreamingAssets"))
+    count = 0
+    for obj in env.objects:
+        if obj.type.name == "MonoBehaviour":
+            script = obj.parse_as_object().m_Script.deref_parse_as_object()
+            assert script.m_ClassName.startswith("Script"), script.m_ClassName
+        elif obj.type.name != "TextAsset":
+            continue
+        obj.parse_as_dict()
+        count += 1
+    return count
+
+
+def discover_files(game_dir: Path) -> list:
+    return [file for file_type, file in iter_asset_files(game_dir) if file_type == FileType.BundleFile]
+
+
+def load_extractor():
+    """导入依赖 pythonnet 的提取代码, 返回 (TextFinder, WriteMonoBehaviour) 或导入失败的原因"""
+    try:
+        from core.UnityExtractor.TextFinder import TextFinder
+        from core.UnityExtractor.WriteMonoBehaviour import WriteMonoBehaviour
+    except (ImportError, RuntimeError) as e:
+        return None, e
+    return (TextFinder, WriteMonoBehaviour), None
+
+
+def open_finder(finder_class, game_dir: Path):
+    finder = finder_class(game_dir)
+    # AssetsTools.assets 是类属性, 清掉上一个阶段加载的文件
+    finder.at.assets.clear()
+    return finder
+
+
+def count_lines(file: Path) -> int:
+    with open(file, "rb") as f:
+        return sum(1 for _ in f)
+
+
+def extract(finder_class, game_dir: Path, workers=1, incremental=False) -> int:
+    finder = open_finder(finder_class, game_dir)
+    try:
+        script_obj_file = finder.load_assets_script_obj(workers=workers, incremental=incremental)
+    finally:
+        finder.at.manager.UnloadAll(True)
+    return count_lines(script_obj_file)
+
+
+def prepare_text(finder_class, game_dir: Path):
+    finder = open_finder(finder_class, game_dir)
+    try:
+        finder.dump_prepare_text()
+    finally:
+        finder.at.manager.UnloadAll(True)
+
+
+def write_back(writer_class, game_dir: Path):
+    writer = open_finder(writer_class, game_dir)
+    try:
+        writer.write_cache_to_file()
+    finally:
+        writer.at.manager.UnloadAll(True)
+
+
+def repack(finder_class, game_dir: Path, files: list[Path]):
+    finder = open_finder(finder_class, game_dir)
+    for file in files:
+        finder.at.compresses_asset_bundle(str(file), str(file.with_suffix(".lz4.bundle")))
+
+
+def fill_translation(cache_dir: Path) -> int:
+    """用 "译" + 原文填充 prepare_text.json, 让 write-back 修改所有找到的文本"""
+    prepare_text_file = cache_dir / "prepare_text.json"
+    with open(prepare_text_file, "r", encoding="utf-8") as f:
+        prepare_text_data = json.load(f)
+    prepare_text_data = {text: "译" + text for text in prepare_text_data}
+    with open(prepare_text_file, "w", encoding="utf-8") as f:
+        json.dump(prepare_text_data, f, ensure_ascii=False)
+    return len(prepare_text_data)
+
+
+class Stages:
+    def __init__(self, trace_memory: bool):
+        self.trace_memory = trace_memory
+        self.rows = []
+
+    def run(self, name: str, function, *args, **kwargs):
+        if self.trace_memory:
+            tracemalloc.start()
+        start = time.perf_counter()
+        result = function(*args, **kwargs)
+        elapsed = time.perf_counter() - start
+        peak = 0
+        if self.trace_memory:
+            peak = tracemalloc.get_traced_memory()[1]
+            tracemalloc.stop()
+        self.rows.append((name, elapsed, peak))
+        return result
+
+    def report(self):
+        print(f"{'stage':<20} {'time (s)':>10} {'peak mem (MB)':>14}")
+        for name, elapsed, peak in self.rows:
+            memory = f"{peak / 1024 / 1024:14.1f}" if self.trace_memory else f"{'-':>14}"
+            print(f"{name:<20} {elapsed:10.3f} {memory}")
+        print(f"{'total':<20} {sum(row[1] for row in self.rows):10.3f}")
+        if self.trace_memory:
+            print("peak mem is the Python heap only, .NET and worker processes are not counted")
+
+
+def main(args):
+    random.seed(args.seed)
+    work_dir = Path(tempfile.mkdtemp(prefix="bench_extract_"))
+    try:
+        game_dir = work_dir / "Game"
+        bundle_dir = game_dir / "Game_Data" / "StreamingAssets"
+        game_dir.mkdir()
+        records_file = work_dir / "script_obj.jsonl"
+        start = time.perf_counter()
+        expected = generate_game(args, game_dir, records_file)
+        print(
+            f"generated {args.bundles} bundles, {expected} assets in {time.perf_counter() - start:.2f} s"
+        )
+        if args.verify:
+            print(f"verified     : {verify_game(game_dir)} assets loaded by UnityPy")
+
+        stages = Stages(not args.no_memory)
+        files = stages.run("discovery", discover_files, game_dir)
+        print(f"files        : {len(files)} bundles")
+
+        extractor, error = load_extractor()
+        if extractor is None:
+            print(
+                f"pythonnet / AssetsTools.NET not available ({error!r}), skipping the extract, "
+                "extract-sharded, extract-incremental, write-back and repack stages "
+                "(load_asset_bundle, iter_monobehaviour/dump_script_obj, update_monobehaviour, "
+                "compresses_asset_bundle); search runs on the generated script_obj.jsonl"
+            )
+            text_num = stages.run(
+                "search", lambda: sum(1 for _ in iter_script_obj_text(records_file))
+            )
+            print(f"text fields  : {text_num}")
+            stages.report()
+            return
+
+        text_finder, write_mono_behaviour = extractor
+        cache_dir = game_dir / "Cache"
+
+        records = stages.run("extract", extract, text_finder, game_dir)
+        print(f"extract      : {records} records, {expected} expected")
+        records = stages.run(
+            "extract-sharded", extract, text_finder, game_dir, workers=args.workers
+        )
+        print(f"sharded      : {records} records with {args.workers} workers")
+
+        write_bundle(args, bundle_dir / "bundle0.bundle", 0)
+        records = stages.run(
+            "extract-incremental", extract, text_finder, game_dir, incremental=True
+        )
+        print(f"incremental  : {records} records after regenerating 1 bundle")
+
+        stages.run("search", prepare_text, text_finder, game_dir)
+        print(f"text fields  : {fill_translation(cache_dir)} unique texts")
+        stages.run("write-back", write_back, write_mono_behaviour, game_dir)
+
+        repack_files = []
+        for bundle_index in range(args.bundles):
+            file = work_dir / f"repack{bundle_index}.bundle"
+            write_bundle(args, file, bundle_index, compressed=False)
+            repack_files.append(file)
+        stages.run("repack", repack, text_finder, game_dir, repack_files)
+
+        stages.report()
+    finally:
+        shutil.rmtree(work_dir, ignore_errors=True)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--bundles", type=int, default=20)
+    parser.add_argument("--monobehaviours", type=int, default=2000)
+    parser.add_argument("--text-assets", type=int, default=200)
+    parser.add_argument("--fields", type=int, default=8, help="每层对象的字符串字段数")
+    parser.add_argument("--depth", type=int, default=3, help="MonoBehaviour 的嵌套深度")
+    parser.add_argument("--japanese-rate", type=float, default=0.3)
+    parser.add_argument("--workers", type=int, default=4, help="extract-sharded 阶段的进程数")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--verify", action="store_true", help="先用 UnityPy 读取生成的 bundle")
+    parser.add_argument("--no-memory", action="store_true", help="不统计内存, tracemalloc 会拖慢计时")
+    main(parser.parse_args())
@@ -0,0 +1,78 @@
+"""日文判断和提取速度: 每次 NFKC + 未编译正则的旧实现与预编译正则, 批量判断对比
+
+python -m benchmark.bench_japanese --lines 200000
+"""
+import re
+import time
+import random
+import argparse
+import unicodedata
+
+from utils import has_japanese, get_japanese_text, has_japanese_batch
+
+from .bench_translate import HIRAGANA, KANA, PUNCTUATION
+
+# 导出的字段大多是变量名, 路径和数字, 只有一小部分是日文, 少量是半角假名等兼容字符
+HALFWIDTH_KANA = "".join(chr(c) for c in range(0xFF66, 0xFF9E))
+ASCII = "abcdefghijklmnopqrstuvwxyz_0123456789/."
+
+
+def make_fields(lines: int, japanese_rate: float, halfwidth_rate: float) -> list[str]:
+    fields = []
+    for _ in range(lines):
+        roll = random.random()
+        if roll < halfwidth_rate:
+            chars = HALFWIDTH_KANA
+        elif roll < halfwidth_rate + japanese_rate:
+            chars = HIRAGANA + KANA + PUNCTUATION + "！？「」"
+        else:
+            chars = ASCII
+        fields.append("".join(random.choices(chars, k=random.randint(1, 40))))
+    return fields
+
+
+def old_has_japanese(text):
+    text = unicodedata.normalize("NFKC", text)
+    return bool(re.search(r"[぀-ヿ㐀-䶿一-鿿]", text))
+
+
+def old_get_japanese_text(text):
+    text = unicodedata.normalize("NFKC", text)
+    return re.findall(r"[぀-ヿ㐀-䶿一-鿿]+", text)
+
+
+def timeit(function, *args):
+    start = time.perf_counter()
+    result = function(*args)
+    return result, time.perf_counter() - start
+
+
+def main(lines: int, japanese_rate: float, halfwidth_rate: float, seed: int):
+    random.seed(seed)
+    fields = make_fields(lines, japanese_rate, halfwidth_rate)
+
+    expected, old_time = timeit(lambda: [old_has_japanese(text) for text in fields])
+    result, new_time = timeit(lambda: [has_japanese(text) for text in fields])
+    batch, batch_time = timeit(has_japanese_batch, fields)
+    assert result == expected and batch == expected, "has_japanese result differs"
+
+    expected_text, old_text_time = timeit(lambda: [old_get_japanese_text(text) for text in fields])
+    result_text, new_text_time = timeit(lambda: [get_japanese_text(text) for text in fields])
+    assert result_text == expected_text, "get_japanese_text result differs"
+
+    print(f"fields: {lines}, japanese: {sum(expected)}")
+    print(f"has_japanese old      : {old_time:8.3f}s")
+    print(f"has_japanese          : {new_time:8.3f}s ({old_time / new_time:.2f}x)")
+    print(f"has_japanese_batch    : {batch_time:8.3f}s ({old_time / batch_time:.2f}x)")
+    print(f"get_japanese_text old : {old_text_time:8.3f}s")
+    print(f"get_japanese_text     : {new_text_time:8.3f}s ({old_text_time / new_text_time:.2f}x)")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--lines", type=int, default=200000)
+    parser.add_argument("--japanese-rate", type=float, default=0.2)
+    parser.add_argument("--halfwidth-rate", type=float, default=0.01)
+    parser.add_argument("--seed", type=int, default=0)
+    args = parser.parse_args()
+    main(args.lines, args.japanese_rate, args.halfwidth_rate, args.seed)
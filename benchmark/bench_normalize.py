@@ -0,0 +1,72 @@
+"""japanese_normalize 速度: 逐个 str.replace 加整行 NFKC 的旧实现, 分段查表替换和带缓存的版本对比
+
+python -m benchmark.bench_normalize --lines 1000000 --duplicate-rate 0.5
+"""
+import time
+import random
+import argparse
+import unicodedata
+
+from utils import japanese_normalize, japanese_normalize_cached
+
+from .bench_translate import HIRAGANA, KANA, PUNCTUATION
+
+# 需要替换的各种破折号, 波浪线和引号
+SYMBOLS = "〜～’”“―‐˗֊‑‒–⁃⁻₋−﹣－—━─「」！？"
+
+
+def make_lines(lines: int, duplicate_rate: float) -> list[str]:
+    result = []
+    for _ in range(lines):
+        if result and random.random() < duplicate_rate:
+            result.append(random.choice(result))
+            continue
+        chars = random.choices(HIRAGANA + KANA, k=random.randint(4, 40))
+        for _ in range(random.randint(0, 3)):
+            chars.insert(random.randint(0, len(chars)), random.choice(SYMBOLS))
+        result.append("".join(chars) + random.choice(PUNCTUATION))
+    return result
+
+
+def old_japanese_normalize(text):
+    text = text.replace("〜", "ー").replace("～", "ー")
+    text = text.replace("’", "'").replace("”", '"').replace("“", '"')
+    text = text.replace("―", "-").replace("‐", "-").replace("˗", "-").replace("֊", "-")
+    text = text.replace("‐", "-").replace("‑", "-").replace("‒", "-").replace("–", "-")
+    text = text.replace("⁃", "-").replace("⁻", "-").replace("₋", "-").replace("−", "-")
+    text = text.replace("﹣", "ー").replace("－", "ー").replace("—", "ー").replace("―", "ー")
+    text = text.replace("━", "ー").replace("─", "ー")
+    return unicodedata.normalize("NFKC", text)
+
+
+def run(function, lines: list[str]) -> tuple[list[str], float]:
+    start = time.perf_counter()
+    result = [function(line) for line in lines]
+    return result, time.perf_counter() - start
+
+
+def main(lines: int, duplicate_rate: float, seed: int):
+    random.seed(seed)
+    text_lines = make_lines(lines, duplicate_rate)
+
+    expected, old_time = run(old_japanese_normalize, text_lines)
+    result, new_time = run(japanese_normalize, text_lines)
+    japanese_normalize_cached.cache_clear()
+    cached, cached_time = run(japanese_normalize_cached, text_lines)
+    assert result == expected and cached == expected, "japanese_normalize result differs"
+
+    info = japanese_normalize_cached.cache_info()
+    print(f"lines: {lines} ({len(set(text_lines))} unique)")
+    print(f"str.replace chain: {old_time:8.3f}s {old_time / lines * 1e6:8.2f} us/line")
+    print(f"segmented table  : {new_time:8.3f}s {new_time / lines * 1e6:8.2f} us/line ({old_time / new_time:.2f}x)")
+    print(f"lru_cache        : {cached_time:8.3f}s {cached_time / lines * 1e6:8.2f} us/line ({old_time / cached_time:.2f}x)")
+    print(f"cache hits/misses: {info.hits}/{info.misses}")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--lines", type=int, default=1000000)
+    parser.add_argument("--duplicate-rate", type=float, default=0.5)
+    parser.add_argument("--seed", type=int, default=0)
+    args = parser.parse_args()
+    main(args.lines, args.duplicate_rate, args.seed)
@@ -0,0 +1,63 @@
+"""对比每个请求新建 ClientSession 与共用连接池的请求速度
+
+python -m benchmark.bench_session --requests 2000 --concurrency 16
+"""
+import time
+import asyncio
+import argparse
+
+import aiohttp
+
+from core.TextGeneration.api import API, TextGenerationAPI
+
+from .fake_server import start_server
+
+PAYLOAD = {"prompt": "こんにちは", "max_tokens": 16}
+
+
+async def run_requests(total: int, concurrency: int, request_fn) -> float:
+    semaphore = asyncio.Semaphore(concurrency)
+
+    async def one():
+        async with semaphore:
+            await request_fn()
+
+    start = time.perf_counter()
+    await asyncio.gather(*[one() for _ in range(total)])
+    return total / (time.perf_counter() - start)
+
+
+async def main(total: int, concurrency: int):
+    runner, url = await start_server()
+    path = API["openai_completions"]["path"]
+
+    async def new_session_request():
+        # 旧的行为: 每个请求都新建 session 和连接
+        async with aiohttp.ClientSession(connector=aiohttp.TCPConnector(ssl=False)) as session:
+            async with session.post(url + path, json=PAYLOAD) as resp:
+                await resp.json()
+
+    api = TextGenerationAPI(url, "", "default", connection_limit=concurrency)
+    await api.open_session()
+
+    async def pooled_request():
+        await api.openai_completions(PAYLOAD)
+
+    try:
+        new_rps = await run_requests(total, concurrency, new_session_request)
+        pooled_rps = await run_requests(total, concurrency, pooled_request)
+    finally:
+        await api.close_session()
+        await runner.cleanup()
+
+    print(f"new session per request: {new_rps:8.1f} req/s")
+    print(f"pooled session         : {pooled_rps:8.1f} req/s")
+    print(f"speedup                : {pooled_rps / new_rps:8.2f}x")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--requests", type=int, default=2000)
+    parser.add_argument("--concurrency", type=int, default=16)
+    args = parser.parse_args()
+    asyncio.run(main(args.requests, args.concurrency))
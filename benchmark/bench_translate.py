@@ -0,0 +1,191 @@
+"""端到端翻译速度: 启动若干个模拟服务器进程, 用 JPTranslator 翻译一批合成的游戏文本
+
+python -m benchmark.bench_translate --lines 2000 --servers 2 --concurrency 4 --latency 0.2 --jitter 0.1
+
+第一台服务器在队列快处理完时故障 (熔断退避期间), 较慢的其他服务器能否接手剩余的任务,
+而不是一直让给退避中的服务器, 等它恢复后才处理完:
+python -m benchmark.bench_translate --lines 1000 --servers 2 --latency 0.05 --slow-factor 4 --outage-start 7 --outage-duration 40
+
+模拟服务器在单独的进程中运行, 统计的 CPU 时间只包含翻译流程本身
+"""
+import time
+import socket
+import random
+import asyncio
+import logging
+import argparse
+import multiprocessing
+
+import aiohttp
+from aiohttp import web
+
+from core import JPTranslator, OpenAiServer
+from utils import logger
+
+from .fake_server import create_app, add_server_arguments
+
+HIRAGANA = "".join(chr(c) for c in range(0x3041, 0x3097))
+KANA = "".join(chr(c) for c in range(0x30A1, 0x30F7))
+PUNCTUATION = "、。！？…"
+
+
+def make_game_text(lines: int, duplicate_rate: float, multiline_rate: float) -> list[str]:
+    """合成游戏文本: 长短不一的日文台词, 一部分重复, 一部分是多行文本"""
+
+    def sentence():
+        chars = HIRAGANA + KANA
+        return "".join(random.choices(chars, k=random.randint(4, 40))) + random.choice(
+            PUNCTUATION
+        )
+
+    text_list = []
+    for _ in range(lines):
+        if text_list and random.random() < duplicate_rate:
+            text_list.append(random.choice(text_list))
+        elif random.random() < multiline_rate:
+            text_list.append("\n".join(sentence() for _ in range(random.randint(2, 4))))
+        else:
+            text_list.append(sentence())
+    return text_list
+
+
+def get_free_port() -> int:
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        return s.getsockname()[1]
+
+
+def run_fake_server(port: int, kwargs: dict):
+    web.run_app(create_app(**kwargs), host="127.0.0.1", port=port, print=None)
+
+
+async def wait_server(url: str, timeout: float = 10):
+    deadline = time.monotonic() + timeout
+    async with aiohttp.ClientSession() as session:
+        while True:
+            try:
+                async with session.options(url + "/") as resp:
+                    if resp.status == 200:
+                        return
+            except aiohttp.ClientError:
+                if time.monotonic() > deadline:
+                    raise
+            await asyncio.sleep(0.1)
+
+
+def percentile(values: list[float], p: float) -> float:
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * p))] if values else 0.0
+
+
+async def main(args):
+    random.seed(args.seed)
+    text_list = make_game_text(args.lines, args.duplicate_rate, args.multiline_rate)
+
+    server_kwargs = {
+        "latency": args.latency,
+        "jitter": args.jitter,
+        "failure_rate": args.failure_rate,
+        "max_concurrency": args.max_concurrency,
+    }
+    processes = []
+    urls = []
+    for index in range(args.servers):
+        kwargs = dict(server_kwargs)
+        if index == 0:
+            kwargs["outage_start"] = args.outage_start
+            kwargs["outage_duration"] = args.outage_duration
+        else:
+            kwargs["latency"] *= args.slow_factor
+            kwargs["jitter"] *= args.slow_factor
+        port = get_free_port()
+        process = multiprocessing.Process(
+            target=run_fake_server, args=(port, kwargs), daemon=True
+        )
+        process.start()
+        processes.append(process)
+        urls.append(f"http://127.0.0.1:{port}")
+
+    try:
+        for url in urls:
+            await wait_server(url)
+
+        tg = JPTranslator()
+        for index, url in enumerate(urls):
+            await tg.connect_server(
+                OpenAiServer(
+                    server_name=f"fake{index}",
+                    api_url=url,
+                    api_key="",
+                    server_type=args.server_type,
+                    concurrency=args.concurrency,
+                    batch_size=args.batch_size,
+                )
+            )
+        await tg.servers_load_default_model(no_log=True)
+
+        # 每个请求从发出到收到结果的耗时, 不包括在队列中等待的时间
+        request_latency = []
+        request_completion = tg.request_completion
+
+        async def timed_request_completion(*args, **kwargs):
+            request_start = time.perf_counter()
+            res_text = await request_completion(*args, **kwargs)
+            request_latency.append(time.perf_counter() - request_start)
+            return res_text
+
+        tg.request_completion = timed_request_completion
+        tg.start_server()
+
+        # 所有行在开始时一起提交, 这里是从开始到每一行完成的时间
+        done_time = []
+        cpu_start = time.process_time()
+        start = time.perf_counter()
+        async for _ in tg.translate_iter(text_list):
+            done_time.append(time.perf_counter() - start)
+        elapsed = time.perf_counter() - start
+        cpu_time = time.process_time() - cpu_start
+    finally:
+        for process in processes:
+            process.terminate()
+
+    unique_lines = len(dict.fromkeys(text_list))
+    print(f"lines        : {len(text_list)} ({unique_lines} unique)")
+    print(f"servers      : {args.servers} x concurrency {args.concurrency}, batch_size {args.batch_size}")
+    print(f"total time   : {elapsed:8.2f} s")
+    print(f"lines/sec    : {unique_lines / elapsed:8.1f}")
+    print(f"request p50  : {percentile(request_latency, 0.5):8.3f} s")
+    print(f"request p99  : {percentile(request_latency, 0.99):8.3f} s")
+    print(f"50% done in  : {percentile(done_time, 0.5):8.2f} s")
+    print(f"99% done in  : {percentile(done_time, 0.99):8.2f} s")
+    print(f"cpu time     : {cpu_time:8.2f} s ({cpu_time / elapsed * 100:.1f}% of wall)")
+    print(f"cpu per line : {cpu_time / unique_lines * 1000:8.3f} ms")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--lines", type=int, default=2000)
+    parser.add_argument("--duplicate-rate", type=float, default=0.2)
+    parser.add_argument("--multiline-rate", type=float, default=0.1)
+    parser.add_argument("--servers", type=int, default=1)
+    parser.add_argument("--server-type", default="default")
+    parser.add_argument("--concurrency", type=int, default=4)
+    parser.add_argument("--batch-size", type=int, default=1)
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument(
+        "--slow-factor", type=float, default=1.0, help="除第一台外其他服务器的耗时倍数"
+    )
+    parser.add_argument(
+        "--outage-start", type=float, default=0.0, help="第一台服务器启动多少秒后开始故障"
+    )
+    parser.add_argument(
+        "--outage-duration", type=float, default=0.0, help="第一台服务器故障持续的秒数"
+    )
+    parser.add_argument("--verbose", action="store_true")
+    add_server_arguments(parser)
+    args = parser.parse_args()
+
+    if not args.verbose:
+        # 每行翻译结果都会打印日志, 会明显影响 CPU 时间
+        logger.setLevel(logging.WARNING)
+    asyncio.run(main(args))
@@ -0,0 +1,149 @@
+"""模拟 text-generation-webui 接口的本地测试服务器
+
+python -m benchmark.fake_server --port 5000 --latency 0.2 --jitter 0.1 --failure-rate 0.01 --max-concurrency 4
+"""
+import time
+import random
+import asyncio
+import argparse
+
+from aiohttp import web
+
+# 与 JPTranslator.make_content 和 make_chat_completions_content 生成的提示词对应
+PROMPT_PREFIX = "翻译成中文："
+PROMPT_SUFFIX = "<|im_end|>"
+
+
+def fake_translate(prompt: str) -> str:
+    """取出提示词中的原文, 每行加上前缀作为译文, 行数与原文一致"""
+    text = prompt.rsplit(PROMPT_PREFIX, 1)[-1].split(PROMPT_SUFFIX, 1)[0]
+    return "\n".join(f"译:{line}" for line in text.split("\n"))
+
+
+async def generate(request: web.Request, prompt: str) -> str | None:
+    """模拟推理耗时和失败, 失败时返回 None"""
+    app = request.app
+    async with app["slots"]:
+        app["requests"] += 1
+        await asyncio.sleep(app["latency"] + random.uniform(0, app["jitter"]))
+        outage_start, outage_end = app["outage"]
+        if (
+            random.random() < app["failure_rate"]
+            or outage_start <= time.monotonic() - app["start_time"] < outage_end
+        ):
+            app["failures"] += 1
+            return None
+    return fake_translate(prompt)
+
+
+def failure_response() -> web.Response:
+    return web.json_response(
+        {"error": "fake server error"}, status=503
+    )
+
+
+async def state(request: web.Request):
+    return web.json_response("OK")
+
+
+async def completions(request: web.Request):
+    body = await request.json()
+    text = await generate(request, body.get("prompt", ""))
+    if text is None:
+        return failure_response()
+    return web.json_response({"choices": [{"text": text}]})
+
+
+async def chat_completions(request: web.Request):
+    body = await request.json()
+    text = await generate(request, body["messages"][-1]["content"])
+    if text is None:
+        return failure_response()
+    return web.json_response({"choices": [{"message": {"content": text}}]})
+
+
+async def model_info(request: web.Request):
+    return web.json_response({"model_name": request.app["model_name"], "lora_names": []})
+
+
+async def model_list(request: web.Request):
+    return web.json_response({"model_names": request.app["model_names"]})
+
+
+async def load_model(request: web.Request):
+    body = await request.json()
+    if body.get("model_name") not in request.app["model_names"]:
+        return web.json_response({"error": "model not found"}, status=400)
+    request.app["model_name"] = body["model_name"]
+    return web.json_response("OK")
+
+
+async def unload_model(request: web.Request):
+    request.app["model_name"] = "None"
+    return web.json_response("OK")
+
+
+def create_app(
+    latency: float = 0.0,
+    jitter: float = 0.0,
+    failure_rate: float = 0.0,
+    max_concurrency: int = 0,
+    model_names: list[str] = None,
+    outage_start: float = 0.0,
+    outage_duration: float = 0.0,
+) -> web.Application:
+    """latency + [0, jitter) 秒后返回结果, failure_rate 的概率返回 503,
+    max_concurrency 模拟显卡同时能处理的请求数, 0 为不限制
+    启动 outage_start 秒后的 outage_duration 秒内所有请求都返回 503
+    """
+    app = web.Application()
+    app["latency"] = latency
+    app["jitter"] = jitter
+    app["failure_rate"] = failure_rate
+    # 不限制时用一个足够大的信号量
+    app["slots"] = asyncio.Semaphore(max_concurrency if max_concurrency > 0 else 1 << 30)
+    app["model_names"] = model_names or ["fake-model"]
+    app["model_name"] = app["model_names"][0]
+    app["requests"] = 0
+    app["failures"] = 0
+    app["start_time"] = time.monotonic()
+    app["outage"] = (outage_start, outage_start + outage_duration)
+
+    app.router.add_route("OPTIONS", "/", state)
+    app.router.add_post("/v1/completions", completions)
+    app.router.add_post("/v1/chat/completions", chat_completions)
+    app.router.add_get("/v1/internal/model/info", model_info)
+    app.router.add_get("/v1/internal/model/list", model_list)
+    app.router.add_post("/v1/internal/model/load", load_model)
+    app.router.add_post("/v1/internal/model/unload", unload_model)
+    return app
+
+
+async def start_server(host="127.0.0.1", port=0, **kwargs) -> tuple[web.AppRunner, str]:
+    """启动服务器, 返回 runner 和服务器地址, port=0 时随机分配端口"""
+    runner = web.AppRunner(create_app(**kwargs))
+    await runner.setup()
+    site = web.TCPSite(runner, host, port)
+    await site.start()
+    port = site._server.sockets[0].getsockname()[1]
+    return runner, f"http://{host}:{port}"
+
+
+def add_server_arguments(parser: argparse.ArgumentParser):
+    parser.add_argument("--latency", type=float, default=0.0)
+    parser.add_argument("--jitter", type=float, default=0.0)
+    parser.add_argument("--failure-rate", type=float, default=0.0)
+    parser.add_argument("--max-concurrency", type=int, default=0)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=5000)
+    add_server_arguments(parser)
+    args = parser.parse_args()
+    web.run_app(
+        create_app(args.latency, args.jitter, args.failure_rate, args.max_concurrency),
+        host=args.host,
+        port=args.port,
+    )
@@ -0,0 +1,310 @@
+"""生成真实格式的 Unity 资源包 (UnityFS + SerializedFile), 给提取流程的基准测试使用
+
+只实现测试需要的部分: Unity 2018.4 的 SerializedFile (格式版本 17, 带类型树),
+MonoBehaviour, MonoScript 和 TextAsset. 类型树和对象数据用 UnityPy 序列化,
+生成的文件可以被 UnityPy 和 AssetsTools.NET 读取
+"""
+import hashlib
+
+from UnityPy.helpers import CompressionHelper
+from UnityPy.helpers.TypeTreeHelper import write_typetree
+from UnityPy.helpers.TypeTreeNode import TypeTreeNode
+from UnityPy.streams import EndianBinaryWriter
+
+UNITY_VERSION = "2018.4.36f1"
+SERIALIZED_FILE_VERSION = 17
+BUNDLE_VERSION = 6
+# StandaloneWindows64
+TARGET_PLATFORM = 19
+BLOCK_SIZE = 0x20000
+
+CLASS_TEXT_ASSET = 49
+CLASS_MONO_BEHAVIOUR = 114
+CLASS_MONO_SCRIPT = 115
+
+# 类型树节点的 meta flag 和 type flag
+ALIGN_BYTES = 0x4000
+ANY_CHILD_USES_ALIGN_BYTES = 0x8000
+IS_ARRAY = 1
+
+# bundle 和其中数据块的压缩方式
+COMPRESSION_NONE = 0
+COMPRESSION_LZ4 = 2
+# 块信息和目录信息写在一起, 紧跟文件头
+BLOCKS_AND_DIRECTORY_INFO_COMBINED = 0x40
+# 目录项是 SerializedFile
+NODE_SERIALIZED_FILE = 4
+
+
+def field(type_name: str, name: str, byte_size=-1, children=(), meta_flag=0, type_flags=0):
+    """类型树节点, 层级和序号在 finish_type_tree 中统一设置"""
+    return TypeTreeNode(
+        m_Level=0,
+        m_Type=type_name,
+        m_Name=name,
+        m_ByteSize=byte_size,
+        m_Version=1,
+        m_Children=list(children),
+        m_TypeFlags=type_flags,
+        m_Index=0,
+        m_MetaFlag=meta_flag,
+    )
+
+
+def array_field(element: TypeTreeNode, meta_flag=ALIGN_BYTES):
+    element.m_Name = "data"
+    return field(
+        "Array",
+        "Array",
+        children=[field("int", "size", 4), element],
+        meta_flag=meta_flag,
+        type_flags=IS_ARRAY,
+    )
+
+
+def string_field(name: str, meta_flag=0):
+    return field(
+        "string",
+        name,
+        children=[array_field(field("char", "data", 1), ALIGN_BYTES | 1)],
+        meta_flag=meta_flag | ANY_CHILD_USES_ALIGN_BYTES,
+    )
+
+
+def vector_field(name: str, element: TypeTreeNode):
+    return field("vector", name, children=[array_field(element)])
+
+
+def pptr_field(name: str, target: str):
+    return field(
+        f"PPtr<{target}>", name, 12, [field("int", "m_FileID", 4), field("SInt64", "m_PathID", 8)]
+    )
+
+
+def finish_type_tree(root: TypeTreeNode) -> TypeTreeNode:
+    """按深度优先的顺序设置每个节点的层级和序号"""
+    stack = [(root, 0)]
+    index = 0
+    while stack:
+        node, level = stack.pop()
+        node.m_Level = level
+        node.m_Index = index
+        index += 1
+        stack.extend((child, level + 1) for child in reversed(node.m_Children))
+    return root
+
+
+def mono_behaviour_type_tree(fields: list[TypeTreeNode]) -> TypeTreeNode:
+    """MonoBehaviour 的固定字段加上脚本中的字段"""
+    return finish_type_tree(
+        field(
+            "MonoBehaviour",
+            "Base",
+            children=[
+                pptr_field("m_GameObject", "GameObject"),
+                field("UInt8", "m_Enabled", 1, meta_flag=ALIGN_BYTES),
+                pptr_field("m_Script", "MonoScript"),
+                string_field("m_Name"),
+                *fields,
+            ],
+        )
+    )
+
+
+def mono_script_type_tree() -> TypeTreeNode:
+    return finish_type_tree(
+        field(
+            "MonoScript",
+            "Base",
+            children=[
+                string_field("m_Name"),
+                field("int", "m_ExecutionOrder", 4),
+                field(
+                    "Hash128",
+                    "m_PropertiesHash",
+                    16,
+                    [field("UInt8", f"bytes[{index}]", 1) for index in range(16)],
+                ),
+                string_field("m_ClassName"),
+                string_field("m_Namespace"),
+                string_field("m_AssemblyName"),
+            ],
+        )
+    )
+
+
+def text_asset_type_tree() -> TypeTreeNode:
+    return finish_type_tree(
+        field("TextAsset", "Base", children=[string_field("m_Name"), string_field("m_Script")])
+    )
+
+
+def make_hash(*parts) -> bytes:
+    return hashlib.md5("|".join(str(part) for part in parts).encode("utf-8")).digest()
+
+
+def mono_script_value(class_name: str, assembly_name="Assembly-CSharp.dll") -> dict:
+    return {
+        "m_Name": class_name,
+        "m_ExecutionOrder": 0,
+        "m_PropertiesHash": {
+            f"bytes[{index}]": byte for index, byte in enumerate(make_hash(class_name))
+        },
+        "m_ClassName": class_name,
+        "m_Namespace": "",
+        "m_AssemblyName": assembly_name,
+    }
+
+
+def mono_behaviour_value(name: str, script_file_id: int, script_path_id: int, value: dict) -> dict:
+    return {
+        "m_GameObject": {"m_FileID": 0, "m_PathID": 0},
+        "m_Enabled": 1,
+        "m_Script": {"m_FileID": script_file_id, "m_PathID": script_path_id},
+        "m_Name": name,
+        **value,
+    }
+
+
+class SerializedFileWriter:
+    """按添加顺序写入类型, 对象, 脚本引用和外部文件引用"""
+
+    def __init__(self):
+        # (class_id, script_index, script_id, type_tree)
+        self.types: list[tuple[int, int, bytes, TypeTreeNode]] = []
+        # (path_id, type_index, data)
+        self.objects: list[tuple[int, int, bytes]] = []
+        # (file_index, path_id)
+        self.script_types: list[tuple[int, int]] = []
+        self.externals: list[str] = []
+
+    def add_type(self, class_id: int, type_tree: TypeTreeNode, script: tuple[int, int] = None) -> int:
+        """添加一个类型, MonoBehaviour 需要指定脚本的 (文件序号, path_id), 返回类型序号"""
+        script_index = -1
+        script_id = b""
+        if script is not None:
+            script_index = len(self.script_types)
+            self.script_types.append(script)
+            script_id = make_hash(*script)
+        self.types.append((class_id, script_index, script_id, type_tree))
+        return len(self.types) - 1
+
+    def add_object(self, path_id: int, type_index: int, value: dict):
+        writer = EndianBinaryWriter(endian="<")
+        write_typetree(value, self.types[type_index][3], writer)
+        self.objects.append((path_id, type_index, writer.bytes))
+
+    def add_external(self, path: str) -> int:
+        """添加外部文件引用, 返回 PPtr 中使用的 m_FileID"""
+        self.externals.append(path)
+        return len(self.externals)
+
+    def to_bytes(self) -> bytes:
+        meta = EndianBinaryWriter(endian="<")
+        meta.write_string_to_null(UNITY_VERSION)
+        meta.write_int(TARGET_PLATFORM)
+        # 包含类型树
+        meta.write_boolean(True)
+
+        meta.write_int(len(self.types))
+        for class_id, script_index, script_id, type_tree in self.types:
+            meta.write_int(class_id)
+            meta.write_boolean(False)
+            meta.write_short(script_index)
+            if class_id == CLASS_MONO_BEHAVIOUR:
+                meta.write_bytes(script_id)
+            meta.write_bytes(make_hash(class_id, script_index))
+            type_tree.dump_blob(meta, SERIALIZED_FILE_VERSION)
+
+        data = EndianBinaryWriter(endian="<")
+        meta.write_int(len(self.objects))
+        for path_id, type_index, object_data in sorted(self.objects, key=lambda o: o[0]):
+            data.align_stream(8)
+            # 文件头 20 字节, 元数据中的对齐与文件中的位置一致
+            meta.align_stream(4)
+            meta.write_long(path_id)
+            meta.write_u_int(data.Position)
+            meta.write_u_int(len(object_data))
+            meta.write_int(type_index)
+            data.write_bytes(object_data)
+
+        meta.write_int(len(self.script_types))
+        for file_index, path_id in self.script_types:
+            meta.write_int(file_index)
+            meta.align_stream(4)
+            meta.write_long(path_id)
+
+        meta.write_int(len(self.externals))
+        for path in self.externals:
+            meta.write_string_to_null("")
+            meta.write_bytes(bytes(16))
+            meta.write_int(0)
+            meta.write_string_to_null(path)
+
+        # userInformation
+        meta.write_string_to_null("")
+
+        header_size = 20
+        data_offset = header_size + meta.Length
+        data_offset += -data_offset % 16
+
+        writer = EndianBinaryWriter(endian=">")
+        writer.write_u_int(meta.Length)
+        writer.write_u_int(data_offset + data.Length)
+        writer.write_u_int(SERIALIZED_FILE_VERSION)
+        writer.write_u_int(data_offset)
+        # 元数据和对象数据为小端序
+        writer.write_boolean(False)
+        writer.write_bytes(bytes(3))
+        writer.write_bytes(meta.bytes)
+        writer.write_bytes(bytes(data_offset - writer.Length))
+        writer.write_bytes(data.bytes)
+        return writer.bytes
+
+
+def pack_bundle(files: list[tuple[str, bytes]], compressed=True) -> bytes:
+    """把若干个 (CAB 名称, SerializedFile) 打包成 UnityFS, 数据按 BLOCK_SIZE 分块 LZ4 压缩"""
+    compression = COMPRESSION_LZ4 if compressed else COMPRESSION_NONE
+    data = b"".join(file_data for _, file_data in files)
+
+    blocks = []
+    for offset in range(0, len(data), BLOCK_SIZE):
+        block = data[offset : offset + BLOCK_SIZE]
+        blocks.append((len(block), CompressionHelper.compress_lz4(block) if compressed else block))
+
+    info = EndianBinaryWriter(endian=">")
+    info.write_bytes(bytes(16))
+    info.write_int(len(blocks))
+    for uncompressed_size, block in blocks:
+        info.write_u_int(uncompressed_size)
+        info.write_u_int(len(block))
+        info.write_u_short(compression)
+    info.write_int(len(files))
+    offset = 0
+    for name, file_data in files:
+        info.write_long(offset)
+        info.write_long(len(file_data))
+        info.write_u_int(NODE_SERIALIZED_FILE)
+        info.write_string_to_null(name)
+        offset += len(file_data)
+    info_data = info.bytes
+    packed_info = CompressionHelper.compress_lz4(info_data) if compressed else info_data
+
+    header = EndianBinaryWriter(endian=">")
+    header.write_string_to_null("UnityFS")
+    header.write_u_int(BUNDLE_VERSION)
+    header.write_string_to_null("5.x.x")
+    header.write_string_to_null(UNITY_VERSION)
+    # 整个文件的大小, 写完文件头后回填
+    size_position = header.Position
+    header.write_long(0)
+    header.write_u_int(len(packed_info))
+    header.write_u_int(len(info_data))
+    header.write_u_int(BLOCKS_AND_DIRECTORY_INFO_COMBINED | compression)
+
+    total_size = header.Length + len(packed_info) + sum(len(block) for _, block in blocks)
+    header.Position = size_position
+    header.write_long(total_size)
+    header.Position = header.Length
+
+    return b"".join([header.bytes, packed_info, *(block for _, block in blocks)])
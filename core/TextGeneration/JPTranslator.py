@@ -1,10 +1,15 @@
+import time
+import asyncio
 import ujson as json
 from pathlib import Path
+from typing import AsyncIterator
+from concurrent.futures import Future
 from tqdm import tqdm
 
-from utils import logger, has_japanese, get_japanese_text, str2md5
+from utils import logger, has_japanese, get_japanese_text, hash_text
+from utils.aho_corasick import AhoCorasick
 
-from .api import QueueTextGenerationAPI, OpenAiServer
+from .api import QueueTextGenerationAPI, OpenAiServer, LINES_PER_SECOND
 from .LocalJsonHandle import LocalJsonHandle
 
 # fmt: off
@@ -161,6 +166,46 @@ class JPTranslator(QueueTextGenerationAPI, LocalJsonHandle):
         glossary: dict[str, str] = None,
         no_save_file: bool = False,
     ) -> str:
+        if tran_cache_file is not None and tran_cache_file.exists():
+            with tran_cache_file.open("r", encoding="utf-8") as f:
+                tran_cache = json.load(f)
+        else:
+            tran_cache = {}
+
+        lines = dict.fromkeys(text_list)
+        start_time = time.perf_counter()
+        with tqdm(total=len(lines)) as pbar:
+            async for line, translated in self.translate_iter(
+                lines, is_strictest, glossary_path, glossary
+            ):
+                # 每行完成后立即写入日志, 中断后可以从日志恢复
+                if not no_save_file:
+                    self.update_prepare_text(line, translated, target_out_file)
+                tran_cache[line] = translated
+                pbar.update()
+
+        logger.info(f"replace data len: {len(lines)}")
+        elapsed = time.perf_counter() - start_time
+        if elapsed > 0:
+            LINES_PER_SECOND.set(len(lines) / elapsed)
+
+        if not no_save_file:
+            self.compact_prepare_text(target_out_file)
+
+        if tran_cache_file is not None:
+            with tran_cache_file.open("w", encoding="utf-8") as f:
+                f.write(json.dumps(tran_cache, ensure_ascii=False, indent=4))
+                
+        return tran_cache
+
+    async def translate_iter(
+        self,
+        text_list: list[str],
+        is_strictest: bool = False,
+        glossary_path: Path = None,
+        glossary: dict[str, str] = None,
+    ) -> AsyncIterator[tuple[str, str]]:
+        """逐行返回 (原文, 译文), 按完成顺序, 已有结果的行最先返回"""
         _glossary, _is_strictest = self.get_config_tag(glossary_path)
         if glossary is None and _glossary is not None:
             glossary = _glossary
@@ -169,86 +214,95 @@ class JPTranslator(QueueTextGenerationAPI, LocalJsonHandle):
             
         is_strictest = is_strictest or _is_strictest
 
-        result_text_list = []
-        text_list_hash_data = {}
+        # 术语表只编译一次, 每行一次扫描找出所有出现的术语
+        glossary_matcher = AhoCorasick(glossary) if glossary else None
 
-        if tran_cache_file is not None and tran_cache_file.exists():
-            with tran_cache_file.open("r", encoding="utf-8") as f:
-                tran_cache = json.load(f)
-        else:
-            tran_cache = {}
+        # 本次请求的翻译结果, 以原文的 hash_text 为键, 不受其他请求或 result_data 清理的影响
+        results: dict[int, str] = {}
+
+        def submit(text: str, gpt_prompt_list: list[dict]) -> tuple[str, Future]:
+            future = self.submit(self.make_content, text, gpt_prompt_list, is_strictest)
+            return hash_text(text), future
 
-        for line in text_list:
+        def compose_line(line: str) -> str:
+            for text_hash, future in line_futures_data[line]:
+                results[text_hash] = future.result()
+            return self.compose_line(line, is_strictest, results)
+
+        line_futures_data: dict[str, list[tuple[int, Future]]] = {}
+        for line in dict.fromkeys(text_list):
+            line_futures = []
             for line_line in line.splitlines():
-                result_text_list.append(line_line)
                 if has_japanese(line_line):
                     if not is_strictest:
                         gpt_prompt_list = []
-                        if glossary is not None:
-                            for key, value in glossary.items():
-                                if key in line_line:
-                                    gpt_prompt_list.append({"src": key, "dst": value})
+                        if glossary_matcher is not None:
+                            for key in glossary_matcher.find_all(line_line):
+                                gpt_prompt_list.append({"src": key, "dst": glossary[key]})
                         
-                        self.queue.put((self.make_content, line_line, gpt_prompt_list, False))
+                        line_futures.append(submit(line_line, gpt_prompt_list))
                     else:
                         for split_text in get_japanese_text(line_line):
                             gpt_prompt_list = []
-                            if glossary is not None:
+                            if glossary_matcher is not None:
                                 if split_text in glossary:
-                                    split_text_hash = str2md5(split_text)
-                                    if split_text_hash not in self.result_data:
-                                        self.result_data[split_text_hash] = glossary[split_text]
-                                        continue
+                                    # 术语直接使用术语表的译文, 只对本次请求生效
+                                    results[hash_text(split_text)] = glossary[split_text]
+                                    continue
                                 else:
-                                    for key, value in glossary.items():
-                                        if key in split_text:
-                                            gpt_prompt_list.append({"src": key, "dst": value})
+                                    for key in glossary_matcher.find_all(split_text):
+                                        gpt_prompt_list.append({"src": key, "dst": glossary[key]})
                                             
-                            self.queue.put((self.make_content, split_text, gpt_prompt_list, is_strictest))
+                            line_futures.append(submit(split_text, gpt_prompt_list))
 
-            line_hash = str2md5(line)
-            result_text_list.append("_<!endofline>" + line_hash)
-            text_list_hash_data[line_hash] = line
+            line_futures_data[line] = line_futures
 
-        self.queue.join()
+        async def wait_line(line: str) -> str:
+            # asyncio.wait 被取消时不会取消共用的 Future
+            await asyncio.wait(
+                [asyncio.wrap_future(future) for _, future in line_futures_data[line]]
+            )
+            return line
 
-        logger.info(f"replace data len: {len(self.result_data)}")
+        wait_tasks = []
+        try:
+            for line, line_futures in line_futures_data.items():
+                if all(future.done() for _, future in line_futures):
+                    yield line, compose_line(line)
+                else:
+                    wait_tasks.append(asyncio.ensure_future(wait_line(line)))
+
+            for wait_task in asyncio.as_completed(wait_tasks):
+                line = await wait_task
+                yield line, compose_line(line)
+        finally:
+            for wait_task in wait_tasks:
+                wait_task.cancel()
+
+    def compose_line(
+        self, line: str, is_strictest: bool = False, results: dict[int, str] = None
+    ) -> str:
+        if results is None:
+            # result_data 中只有没有术语表的非 strictest 结果以原文为键
+            results = self.result_data
 
         current_line = []
+        for line_line in line.splitlines():
+            if not is_strictest:
+                current_line.append(results.get(hash_text(line_line), line_line))
+                continue
 
-        with tqdm(total=len(result_text_list)) as pbar:
-            for line in result_text_list:
-                pbar.update()
-                if line.startswith("_<!endofline>"):
-                    current_line_hash = line[13:]
-                    if not no_save_file:
-                        self.update_prepare_text(
-                            text_list_hash_data[current_line_hash],
-                            "\n".join(current_line),
-                            target_out_file,
-                        )
-                    tran_cache[text_list_hash_data[current_line_hash]] = "\n".join(current_line)
-                    current_line = []
-                    continue
-                
-                if not is_strictest:
-                    current_line.append(self.result_data.get(str2md5(line), line))
-                else:
-                    if not has_japanese(line):
-                        current_line.append(line)
-                        continue
-                    
-                    new_line: str = line
-                    for split_text in get_japanese_text(line):
-                        s_text = self.result_data.get(str2md5(split_text), split_text)
-                        new_line = new_line.replace(split_text, s_text)
-                    current_line.append(new_line)
-                        
-        if tran_cache_file is not None:
-            with tran_cache_file.open("w", encoding="utf-8") as f:
-                f.write(json.dumps(tran_cache, ensure_ascii=False, indent=4))
-                
-        return tran_cache
+            if not has_japanese(line_line):
+                current_line.append(line_line)
+                continue
+
+            new_line: str = line_line
+            for split_text in get_japanese_text(line_line):
+                s_text = results.get(hash_text(split_text), split_text)
+                new_line = new_line.replace(split_text, s_text)
+            current_line.append(new_line)
+
+        return "\n".join(current_line)
 
     async def translate2(
         self,
@@ -1,6 +1,8 @@
+import os
 import ujson as json
 
 from pathlib import Path
+from threading import Lock
 from utils import logger, find_unity_game_data_path
 
 
@@ -13,11 +15,35 @@ def read_json(file_path: Path):
     return data
 
 
+def read_journal(journal_path: Path):
+    """读取翻译日志, 每行一条 {"key": 原文, "value": 译文} 记录, 后写入的覆盖先写入的"""
+    data = {}
+    if not journal_path.exists():
+        return data
+
+    with open(journal_path, "r", encoding="utf-8") as f:
+        for line in f:
+            try:
+                record = json.loads(line)
+            except ValueError:
+                # 程序中途退出时最后一行可能不完整
+                continue
+            data[record["key"]] = record["value"]
+    return data
+
+
 class LocalJsonHandle:
     prepare_data = None
     out_json_name = "prepare_text.json"
     out_json_path = None
 
+    journal_suffix = ".journal"
+    # 日志累计多少条记录后合并回 prepare_text.json
+    journal_compact_size = 5000
+    journal_lock = Lock()
+    _journal_file = None
+    _journal_count = 0
+
     def set_cache_path(self, cache_path: Path):
         if cache_path.suffix == ".exe":
             self.cache_path = cache_path.parent
@@ -35,11 +61,23 @@ class LocalJsonHandle:
         self.out_json_path = prepare_text_path
         self.cache_path = prepare_text_path.parent
 
+    def get_journal_path(self, target_file: Path = None) -> Path:
+        if target_file is None:
+            target_file = self.cache_path / self.out_json_name
+        target_file = target_file if isinstance(target_file, Path) else Path(target_file)
+        return target_file.with_name(target_file.name + self.journal_suffix)
+
     def load_prepare_text(self, target_file: Path = None):
         if target_file is None:
             target_file = self.cache_path / self.out_json_name
         
-        return read_json(target_file)
+        data = read_json(target_file)
+        # 合并上次未完成运行留下的日志
+        journal_data = read_journal(self.get_journal_path(target_file))
+        if journal_data:
+            logger.info(f"resume {len(journal_data)} translated lines from journal")
+            data.update(journal_data)
+        return data
 
     def read_prompt_text(self):
         return read_json(self.cache_path / "prompt_text.json")
@@ -51,14 +89,45 @@ class LocalJsonHandle:
     def save_prepare_text(self, data: dict, target_file: Path = None):
         if target_file is None:
             target_file = self.cache_path / self.out_json_name
-        
-        with open(target_file, "w", encoding="utf-8") as f:
+        target_file = target_file if isinstance(target_file, Path) else Path(target_file)
+
+        # 先写临时文件再替换, 写入中途退出时不会损坏原文件
+        temp_file = target_file.with_name(target_file.name + ".tmp")
+        with open(temp_file, "w", encoding="utf-8") as f:
             json.dump(data, f, ensure_ascii=False, indent=4)
+        os.replace(temp_file, target_file)
 
     def update_prepare_text(self, key: str, value: str, target_file: Path = None)   :
-        if self.prepare_data is None:
-            self.prepare_data = self.load_prepare_text(target_file)
-        if self.prepare_data is None:
-            return
-        self.prepare_data[key] = value
-        self.save_prepare_text(self.prepare_data, target_file)
+        with self.journal_lock:
+            if self.prepare_data is None:
+                self.prepare_data = self.load_prepare_text(target_file)
+            if self.prepare_data is None:
+                return
+            self.prepare_data[key] = value
+
+            if self._journal_file is None:
+                self._journal_file = open(
+                    self.get_journal_path(target_file), "a", encoding="utf-8"
+                )
+            record = json.dumps({"key": key, "value": value}, ensure_ascii=False)
+            self._journal_file.write(record + "\n")
+            self._journal_file.flush()
+            self._journal_count += 1
+
+        if self._journal_count >= self.journal_compact_size:
+            self.compact_prepare_text(target_file)
+
+    def compact_prepare_text(self, target_file: Path = None):
+        """将日志中的记录合并回 prepare_text.json 并清空日志"""
+        with self.journal_lock:
+            if self._journal_file is not None:
+                self._journal_file.close()
+                self._journal_file = None
+
+            if self.prepare_data is None:
+                return
+
+            # prepare_text.json 替换完成后才删除日志, 中途退出时日志仍可恢复
+            self.save_prepare_text(self.prepare_data, target_file)
+            self.get_journal_path(target_file).unlink(missing_ok=True)
+            self._journal_count = 0
@@ -0,0 +1,228 @@
+import time
+import atexit
+import sqlite3
+import ujson as json
+
+from pathlib import Path
+from threading import Lock, Event, Thread
+
+from utils import logger, has_japanese, japanese_normalize_cached, str2md5
+
+TRANSLATION_MEMORY_PATH = Path("translation_memory.db")
+
+
+class TranslationMemory:
+    """跨游戏共用的本地翻译记忆
+
+    以 japanese_normalize 后的原文和模型/提示词指纹作为键保存译文,
+    指纹为空的记录 (从翻译缓存导入的) 对所有模型生效, 但不用于带术语表或 is_strictest 的请求,
+    这些请求的译文和普通翻译不同.
+    记录数超过 max_entries 时按最近使用时间淘汰.
+
+    set 和 get 更新的使用时间先放在内存中, 由后台线程批量提交, 不阻塞调用方
+    """
+
+    # 每插入多少条检查一次容量
+    evict_interval = 1000
+    # 后台线程每隔多少秒, 或缓冲区超过多少条时提交一次
+    flush_interval = 1.0
+    flush_size = 500
+
+    def __init__(self, db_path: Path | str, max_entries: int = 1_000_000):
+        self.db_path = Path(db_path)
+        self.max_entries = max_entries
+        self.lock = Lock()
+        self.conn = sqlite3.connect(str(self.db_path), check_same_thread=False)
+        self.conn.execute("PRAGMA journal_mode=WAL")
+        self.conn.execute("PRAGMA synchronous=NORMAL")
+        self.conn.execute(
+            """CREATE TABLE IF NOT EXISTS memory (
+                source TEXT NOT NULL,
+                fingerprint TEXT NOT NULL,
+                translation TEXT NOT NULL,
+                last_used REAL NOT NULL,
+                PRIMARY KEY (source, fingerprint)
+            )"""
+        )
+        self.conn.execute(
+            "CREATE INDEX IF NOT EXISTS memory_last_used ON memory (last_used)"
+        )
+        self.conn.commit()
+        self._insert_count = 0
+
+        # 还没有提交的写入: (原文, 指纹) -> (译文, 时间) 和 (原文, 指纹) -> 使用时间
+        self.pending_lock = Lock()
+        self._pending: dict[tuple[str, str], tuple[str, float]] = {}
+        self._touched: dict[tuple[str, str], float] = {}
+        self._flush_event = Event()
+        self._closed = False
+        self._writer = Thread(target=self._write_loop, daemon=True)
+        self._writer.start()
+        atexit.register(self.close)
+
+    @staticmethod
+    def make_fingerprint(*parts) -> str:
+        return str2md5("|".join(str(part) for part in parts))
+
+    def get(self, text: str, fingerprint: str = "", shared: bool = True) -> str | None:
+        """查询一条译文, 会读取数据库, 在事件循环中应放到线程里调用
+
+        shared 为 False 时只接受指纹相同的记录, 不使用指纹为空的导入记录
+        """
+        source = japanese_normalize_cached(text)
+        with self.pending_lock:
+            pending = self._pending.get((source, fingerprint))
+        if pending is not None:
+            return pending[0]
+
+        # flush 先取得 self.lock 再取出缓冲区, 这里拿到锁时缓冲区的内容已经提交
+        fingerprints = (fingerprint, "") if shared else (fingerprint, fingerprint)
+        with self.lock:
+            row = self.conn.execute(
+                "SELECT fingerprint, translation FROM memory WHERE source = ? AND fingerprint IN (?, ?) ORDER BY fingerprint = '' LIMIT 1",
+                (source, *fingerprints),
+            ).fetchone()
+
+        with self.pending_lock:
+            if shared and (row is None or row[0] != fingerprint):
+                pending = self._pending.get((source, ""))
+                if pending is not None:
+                    return pending[0]
+            if row is None:
+                return None
+            self._touched[(source, row[0])] = time.time()
+        return row[1]
+
+    def set(self, text: str, translation: str, fingerprint: str = ""):
+        """写入缓冲区, 由后台线程批量提交"""
+        source = japanese_normalize_cached(text)
+        with self.pending_lock:
+            self._pending[(source, fingerprint)] = (translation, time.time())
+            if len(self._pending) >= self.flush_size:
+                self._flush_event.set()
+
+    def _write_loop(self):
+        while not self._closed:
+            self._flush_event.wait(self.flush_interval)
+            self._flush_event.clear()
+            try:
+                self.flush()
+            except sqlite3.Error as e:
+                logger.error(f"translation memory flush error: {e!r}")
+
+    def flush(self):
+        """提交缓冲区中的写入和使用时间"""
+        with self.lock:
+            with self.pending_lock:
+                pending, self._pending = self._pending, {}
+                touched, self._touched = self._touched, {}
+            if not pending and not touched:
+                return
+            self.conn.executemany(
+                "INSERT OR REPLACE INTO memory (source, fingerprint, translation, last_used) VALUES (?, ?, ?, ?)",
+                [
+                    (source, fingerprint, translation, last_used)
+                    for (source, fingerprint), (translation, last_used) in pending.items()
+                ],
+            )
+            self.conn.executemany(
+                "UPDATE memory SET last_used = ? WHERE source = ? AND fingerprint = ?",
+                [
+                    (last_used, source, fingerprint)
+                    for (source, fingerprint), last_used in touched.items()
+                ],
+            )
+            self.conn.commit()
+            self._count_insert(len(pending))
+
+    def set_many(self, items: list[tuple[str, str]], fingerprint: str = ""):
+        """直接批量写入数据库, 用于导入"""
+        now = time.time()
+        rows = [
+            (japanese_normalize_cached(text), fingerprint, translation, now)
+            for text, translation in items
+        ]
+        with self.lock:
+            self.conn.executemany(
+                "INSERT OR REPLACE INTO memory (source, fingerprint, translation, last_used) VALUES (?, ?, ?, ?)",
+                rows,
+            )
+            self.conn.commit()
+            self._count_insert(len(rows))
+
+    def _count_insert(self, count: int):
+        """调用方需持有 self.lock"""
+        self._insert_count += count
+        if self._insert_count >= self.evict_interval:
+            self._insert_count = 0
+            self._evict()
+
+    def _evict(self):
+        count = self.conn.execute("SELECT COUNT(*) FROM memory").fetchone()[0]
+        if count <= self.max_entries:
+            return
+        self.conn.execute(
+            "DELETE FROM memory WHERE rowid IN (SELECT rowid FROM memory ORDER BY last_used LIMIT ?)",
+            (count - self.max_entries,),
+        )
+        self.conn.commit()
+        logger.info(f"translation memory evict {count - self.max_entries} entries")
+
+    def __len__(self):
+        self.flush()
+        with self.lock:
+            return self.conn.execute("SELECT COUNT(*) FROM memory").fetchone()[0]
+
+    def import_json(self, json_path: Path, fingerprint: str = "") -> int:
+        """导入 {原文: 译文} 格式的翻译缓存, 例如 xxx_Translated.json 或 prepare_text.json"""
+        with open(json_path, "r", encoding="utf-8") as f:
+            data: dict[str, str] = json.load(f)
+
+        items = []
+        for source, translation in data.items():
+            if not translation or source == translation or not has_japanese(source):
+                continue
+            source_lines = source.splitlines()
+            translation_lines = translation.splitlines()
+            # 多行文本在翻译时是逐行请求的, 行数一致时按行保存
+            if len(source_lines) > 1 and len(source_lines) == len(translation_lines):
+                items.extend(
+                    (s, t)
+                    for s, t in zip(source_lines, translation_lines)
+                    if has_japanese(s)
+                )
+            else:
+                items.append((source, translation))
+
+        self.set_many(items, fingerprint)
+        logger.info(f"import {len(items)} entries from {json_path}")
+        return len(items)
+
+    def export_json(self, json_path: Path, fingerprint: str = None) -> int:
+        self.flush()
+        with self.lock:
+            if fingerprint is None:
+                rows = self.conn.execute(
+                    "SELECT source, translation FROM memory ORDER BY last_used"
+                ).fetchall()
+            else:
+                rows = self.conn.execute(
+                    "SELECT source, translation FROM memory WHERE fingerprint = ? ORDER BY last_used",
+                    (fingerprint,),
+                ).fetchall()
+
+        with open(json_path, "w", encoding="utf-8") as f:
+            json.dump(dict(rows), f, ensure_ascii=False, indent=4)
+        logger.info(f"export {len(rows)} entries to {json_path}")
+        return len(rows)
+
+    def close(self):
+        if self._closed:
+            return
+        self._closed = True
+        self._flush_event.set()
+        self._writer.join()
+        self.flush()
+        with self.lock:
+            self.conn.close()
+        atexit.unregister(self.close)
@@ -1,18 +1,25 @@
+import time
 import asyncio
+import itertools
 from aiohttp import client_exceptions
-from queue import Queue
+from concurrent.futures import Future
 from threading import Thread, Lock
 
-from typing import Any, TypeVar, List, Dict
+from typing import Any, Callable, TypeVar, List, Dict
 from pydantic import BaseModel, FilePath
 
 
 from collections import namedtuple
 
 from .typing import ChatCompletionRequest, CurrentModelInfo
+from .TranslationMemory import TranslationMemory
+from .scheduler import LatencyScheduler
+from .breaker import CircuitBreaker, BreakerState, backoff_delay, is_transient_error
+from .rate_limit import RateLimiter, estimate_tokens
 from utils.session import HTTPMethod, HTTPSessionApi
 
-from utils import logger, read_yaml, str2md5, has_japanese, japanese_normalize
+from utils import logger, read_yaml, hash_text, has_japanese, japanese_normalize_cached
+from utils.metrics import Counter, Gauge, Histogram
 
 T = TypeVar("T")
 
@@ -50,6 +57,9 @@ API_PARAMS = namedtuple("API_PARAMS", "method, path")
 OPENKEY_STATE = namedtuple("OPENKEY_STATE", "Status, Total, Used, Remaining")
 OPENKEY_STATE_ERROR = namedtuple("OPENKEY_STATE_ERROR", "Status, Error")
 
+# 发送前构造好的请求, tokens 为限流用的估算 token 数 (提示词加上输出)
+COMPLETION_REQUEST = namedtuple("COMPLETION_REQUEST", "payload, prompt_tokens, tokens")
+
 
 class TextGenerationAPI(HTTPSessionApi):
     model_config: dict
@@ -66,11 +76,16 @@ class TextGenerationAPI(HTTPSessionApi):
         model_config: dict = None,
         model_name: str = None,
         http_proxy: str = None,
+        connection_limit: int = 100,
+        keepalive_timeout: float = 30,
+        dns_cache_ttl: int = 300,
     ):
         self.api_key = api_key
         self.server_type = server_type
         self.model_name = model_name
-        super().__init__(api_url, http_proxy)
+        super().__init__(
+            api_url, http_proxy, connection_limit, keepalive_timeout, dns_cache_ttl
+        )
         self.model_config = model_config or {}
 
     async def request(self, api: API_PARAMS, raise_error=True, **kwargs) -> Any:
@@ -175,6 +190,55 @@ class OpenAiServer(BaseModel):
 
     http_proxy: str = None
 
+    # 连接池配置
+    connection_limit: int = 100
+    keepalive_timeout: float = 30
+    dns_cache_ttl: int = 300
+
+    # 同一个服务器同时进行的请求数
+    concurrency: int = 1
+
+    # 多行短文本合并到一个请求中翻译, batch_size=1 时不合并
+    batch_size: int = 1
+    batch_max_chars: int = 200
+
+    # 队列为空且服务器空闲时, 为其他服务器上耗时过长的请求发送备份请求, 先返回的结果生效
+    hedge: bool = False
+
+    # 每分钟最多请求数和 token 数, 按服务商的限制填写, 0 为不限制
+    rpm: int = 0
+    tpm: int = 0
+
+
+QUEUE_DEPTH = Gauge("translator_queue_depth", "任务队列中等待翻译的文本数")
+REQUEST_SECONDS = Histogram(
+    "translator_request_seconds", "每次请求服务器的耗时 (秒)", ["server"]
+)
+TOKENS = Counter(
+    "translator_tokens_total", "估算的 token 数, direction 为 in/out", ["server", "direction"]
+)
+CACHE_LOOKUPS = Counter(
+    "translator_cache_lookups_total",
+    "缓存查询次数, cache 为 result/pending/memory, result 为 hit/miss",
+    ["cache", "result"],
+)
+RETRIES = Counter("translator_retries_total", "放回队列重新翻译的文本数", ["server", "reason"])
+REJECTED_OUTPUTS = Counter(
+    "translator_rejected_outputs_total", "被丢弃或截断的模型输出数", ["server", "reason"]
+)
+TRANSLATED_LINES = Counter("translator_lines_total", "翻译完成的文本数", ["server"])
+LINES_PER_SECOND = Gauge("translator_lines_per_second", "最近一次翻译任务的速度 (行/秒)")
+# 调度器的统计数据, 读取指标时从 LatencyScheduler.summary 取得, 还没有统计数据时为 0
+SCHEDULER_GAUGES = {
+    "inflight": Gauge("translator_server_inflight", "服务器正在处理的请求数", ["server"]),
+    "latency": Gauge(
+        "translator_server_latency_seconds", "调度器估计的每个请求耗时 (秒, EWMA)", ["server"]
+    ),
+    "chars_per_sec": Gauge(
+        "translator_server_chars_per_second", "调度器估计的每秒处理原文字符数 (EWMA)", ["server"]
+    ),
+}
+
 
 class QueueServers(BaseModel):
     api: TextGenerationAPI
@@ -186,15 +250,54 @@ class QueueServers(BaseModel):
 
 class QueueTextGenerationAPI:
     servers: List[QueueServers] = []
-    queue: Queue
+    queue: asyncio.Queue
+    worker_loop: asyncio.AbstractEventLoop = None
     result_lock: Lock
-    result_data: Dict[str, str] = {}
+    # 以下几个字典的键都是 result_key, 同一原文在不同术语表或 is_strictest 下分开保存
+    result_data: Dict[int, str] = {}
+    # 已经入队但还没有结果的文本, 同一文本只请求一次
+    pending_data: Dict[int, Future]
+    translation_memory: TranslationMemory = None
+    scheduler: LatencyScheduler
+    # 慢服务器把任务让给快服务器后等待多久再取任务
+    yield_delay = 0.05
+    # 请求耗时超过最近请求耗时的这个分位数 (且不少于 hedge_min_delay 秒) 时发送备份请求
+    hedge_percentile = 0.95
+    hedge_min_delay = 2.0
+    hedge_interval = 0.2
+    # 正在请求中的单条文本, 用于发送备份请求
+    inflight_data: Dict[int, dict]
+    # 每台服务器的熔断器, 重连后继续使用
+    breakers: Dict[str, CircuitBreaker]
+    rate_limiters: Dict[str, RateLimiter]
 
     def __init__(self):
-        self.queue = Queue()
+        self.queue = asyncio.Queue()
         self.result_lock = Lock()
+        self.pending_data = {}
+        self.inflight_data = {}
+        self.breakers = {}
+        self.rate_limiters = {}
+        self.scheduler = LatencyScheduler()
+        QUEUE_DEPTH.set_function(self.queue.qsize)
+
+    async def run_in_worker_loop(self, coro):
+        """在 worker 事件循环中运行 coro
+
+        aiohttp 的 session 按事件循环创建, 服务器的请求都放到 worker 事件循环中,
+        每个 TextGenerationAPI 只有一个 session, 断开时由 run_server 关闭
+        """
+        worker_loop = self.get_worker_loop()
+        if asyncio.get_running_loop() is worker_loop:
+            return await coro
+        return await asyncio.wrap_future(
+            asyncio.run_coroutine_threadsafe(coro, worker_loop)
+        )
 
     async def connect_server(self, server: OpenAiServer) -> QueueServers:
+        return await self.run_in_worker_loop(self._connect_server(server))
+
+    async def _connect_server(self, server: OpenAiServer) -> QueueServers:
         model_config = None
         if server.model_config_path is not None:
             model_config = read_yaml(server.model_config_path)
@@ -206,21 +309,103 @@ class QueueTextGenerationAPI:
             model_config,
             server.model_name,
             server.http_proxy,
+            server.connection_limit,
+            server.keepalive_timeout,
+            server.dns_cache_ttl,
         )
         if not await api.state():
+            await api.close_session()
             return None
         qs = QueueServers(api=api, config=server)
         self.servers.append(qs)
         return qs
 
+    def get_worker_loop(self) -> asyncio.AbstractEventLoop:
+        """所有服务器的请求都在同一个后台事件循环中运行"""
+        if self.worker_loop is None:
+            self.worker_loop = asyncio.new_event_loop()
+            t = Thread(target=self.worker_loop.run_forever, daemon=True)
+            t.start()
+        return self.worker_loop
+
     def start_server(self, server: OpenAiServer = None):
         servers = [server] if server else self.servers
         for s in servers:
-            t = Thread(target=self.run_async_server, args=(s,), daemon=True)
-            t.start()
+            future = asyncio.run_coroutine_threadsafe(
+                self.run_server(s), self.get_worker_loop()
+            )
+            future.add_done_callback(self.log_server_exception)
+
+    @staticmethod
+    def log_server_exception(future):
+        if not future.cancelled() and future.exception() is not None:
+            logger.error(f"Server worker stopped: {future.exception()!r}")
+
+    def put_queue(self, item: tuple):
+        """线程安全地向任务队列添加任务"""
+        self.get_worker_loop().call_soon_threadsafe(self.queue.put_nowait, item)
 
-    def run_async_server(self, server: QueueServers):
-        asyncio.run(self.run_server(server))
+    def submit(
+        self,
+        make_content: Callable,
+        text: str,
+        gpt_prompt_list: list[dict],
+        is_strictest: bool,
+    ) -> Future:
+        """提交一条待翻译文本, 返回该文本翻译结果的 Future
+
+        已经有结果或者正在翻译的文本不会重复入队, 所有等待者共用同一个 Future
+        """
+        text_hash = self.result_key(text, gpt_prompt_list, is_strictest)
+        with self.result_lock:
+            if text_hash in self.result_data:
+                CACHE_LOOKUPS.labels("result", "hit").inc()
+                future = Future()
+                future.set_result(self.result_data[text_hash])
+                return future
+
+            future = self.pending_data.get(text_hash)
+            if future is not None:
+                CACHE_LOOKUPS.labels("pending", "hit").inc()
+                return future
+
+            CACHE_LOOKUPS.labels("result", "miss").inc()
+            future = Future()
+            self.pending_data[text_hash] = future
+
+        self.put_queue((make_content, text, gpt_prompt_list, is_strictest))
+        return future
+
+    @staticmethod
+    def result_key(text: str, gpt_prompt_list: list[dict], is_strictest: bool) -> int:
+        """共享的翻译结果的键, 术语表和 is_strictest 都会影响译文, 不同时不能共用结果"""
+        if not gpt_prompt_list and not is_strictest:
+            return hash_text(text)
+        glossary = "\n".join(
+            f"{p['src']}->{p['dst']}#{p.get('info', '')}" for p in gpt_prompt_list or []
+        )
+        return hash_text(f"{text}\0{glossary}\0{is_strictest:d}")
+
+    @classmethod
+    def item_key(cls, item: tuple) -> int:
+        _, text, gpt_prompt_list, is_strictest = item
+        return cls.result_key(text, gpt_prompt_list, is_strictest)
+
+    def store_result(self, text_hash: int, res_text: str):
+        """保存翻译结果并通知等待者, 调用方需持有 result_lock"""
+        self.result_data[text_hash] = res_text
+        future = self.pending_data.pop(text_hash, None)
+        if future is not None and not future.done():
+            future.set_result(res_text)
+
+    def trim_result_data(self, max_size: int):
+        """只保留最近的 max_size 条翻译结果, 常驻运行时避免 result_data 无限增长"""
+        with self.result_lock:
+            over_size = len(self.result_data) - max_size
+            if over_size <= 0:
+                return
+            for text_hash in list(itertools.islice(self.result_data, over_size)):
+                del self.result_data[text_hash]
 
     @staticmethod
     def make_chat_completions_content(
@@ -248,115 +433,533 @@ class QueueTextGenerationAPI:
         return {"role": "user", "content": pre_content + user_prompt}
 
     async def run_server(self, server: QueueServers):
+        concurrency = max(1, server.config.concurrency)
+        self.scheduler.register(server.config.server_name, concurrency)
+        self.export_scheduler_metrics(server.config.server_name)
+        workers = [
+            asyncio.create_task(self.server_worker(server)) for _ in range(concurrency)
+        ]
+        if server.config.hedge:
+            workers.append(asyncio.create_task(self.hedge_worker(server)))
+        # 暂时性的错误由熔断器处理, 其他错误认为服务器断开, 停止其他请求
+        await asyncio.wait(workers, return_when=asyncio.FIRST_COMPLETED)
+        for worker in workers:
+            worker.cancel()
+        await asyncio.gather(*workers, return_exceptions=True)
+
+        logger.error(f"Server [{server.config.server_name}] is disconnected.")
+
+        await self.disconnect_server(server)
+        await self.wait_server_reconnect(server.config)
+
+    async def disconnect_server(self, server: QueueServers):
+        await server.api.close_session()
+        if server in self.servers:
+            self.servers.remove(server)
+
+    def export_scheduler_metrics(self, server_name: str):
+        for field, gauge in SCHEDULER_GAUGES.items():
+            gauge.labels(server_name).set_function(
+                lambda field=field: self.scheduler.summary()[server_name][field] or 0
+            )
+
+    def get_breaker(self, server_name: str) -> CircuitBreaker:
+        if server_name not in self.breakers:
+            self.breakers[server_name] = CircuitBreaker()
+        return self.breakers[server_name]
+
+    def get_rate_limiter(self, config: OpenAiServer) -> RateLimiter:
+        if config.server_name not in self.rate_limiters:
+            self.rate_limiters[config.server_name] = RateLimiter(config.rpm, config.tpm)
+        return self.rate_limiters[config.server_name]
+
+    async def server_worker(self, server: QueueServers):
+        server_name = server.config.server_name
+        breaker = self.get_breaker(server_name)
         while True:
-            make_content, text, gpt_prompt_list, is_strictest = self.queue.get()
-            text_hash = str2md5(text)
+            # 熔断期间不从队列取任务, 让其他服务器处理
+            is_probe = await breaker.acquire()
+            item = await self.queue.get()
+            items = [item]
+            text = item[1]
+            requested = False
             try:
+                text_hash = self.item_key(item)
                 if text_hash in self.result_data:
                     logger.info(f"{self.queue.qsize()} [{text}] already generated.")
+                    with self.result_lock:
+                        self.store_result(text_hash, self.result_data[text_hash])
                     continue
 
-                if self.queue.qsize() == 0 and server.api.server_type != "default" and len(self.servers) > 1:
-                    self.queue.put((make_content, text, gpt_prompt_list, is_strictest))
+                if await self.lookup_memory(server, item):
                     continue
 
-                # logger.info(f"{self.queue.qsize()} [{server.config.server_name}] -: {text}")
-
-                base_payload = {
-                    "stream": False,
-                    "max_tokens": 512,
-                    "temperature": 0.1,
-                    "top_p": 0.3,
-                    "frequency_penalty": 0.05,
-                }
-
-                if server.api.server_type != "default":
-                    payload = {
-                        "model": server.api.model_name,
-                        "messages": [
-                            QueueTextGenerationAPI.make_chat_completions_content(
-                                japanese_normalize(text), gpt_prompt_list
-                            )
-                        ],
-                    }
-                    payload.update(base_payload)
-
-                    res_text: str = await server.api.openai_chat_completions(payload)
-                    if text == res_text:
-                        self.queue.put(
-                            (make_content, text, gpt_prompt_list, is_strictest)
-                        )
-                        continue
-
-                    res_text_split = res_text.split("\n")
-                    if len(res_text_split) > 1:
-                        res_text = res_text_split[-1]
-
-                    res_text = res_text.replace("“", "").replace("”", "")
-                else:
-                    payload = {
-                        "prompt": make_content(
-                            japanese_normalize(text), gpt_prompt_list
-                        ),
-                        "top_k": 40,
-                        "repetition_penalty": 1,
-                        "do_sample": True,
-                        "num_beams": 1,
-                    }
-                    payload.update(base_payload)
-                    res_text: str = await server.api.openai_completions(payload)
-
-                if is_strictest:
-                    for end in ["。", "？", "！", "，", "—", "…"]:
-                        if res_text.endswith(end):
-                            res_text = res_text.rstrip(end)
-                            break
-
-                if not text.endswith("。") and res_text.endswith("。"):
-                    res_text = res_text.rstrip("。")
-
-                with self.result_lock:
-                    if len(res_text) > 500:
-                        res_text = res_text[: len(text)]
-                        text_list = list(text)
-                        text_list.reverse()
-                        text_end = []
-                        for char in text_list:
-                            if not has_japanese(char):
-                                text_end.append(char)
-                            else:
-                                break
-                        text_end.reverse()
-                        res_text += "".join(text_end)
-
-                    self.result_data[text_hash] = res_text
-                    # logger.info(f"[{server.config.server_name}] +: {res_text}")
-                    # fmt: off
-                    logger.info(f"{self.queue.qsize()} \033[0m(\033[36m{server.config.server_name}\033[0m) [ \033[0;33m{text}\033[0m ] -> [ \033[35m{res_text}\033[0m ]")
-                    # fmt: on
+                # 熔断中的服务器暂时不会取任务, 不算作可以接手的服务器
+                if not self.scheduler.should_take(
+                    server_name,
+                    len(text),
+                    self.queue.qsize(),
+                    [
+                        s.config.server_name
+                        for s in self.servers
+                        if self.get_breaker(s.config.server_name).can_request()
+                    ],
+                ):
+                    # 队列快空了, 留给更快的服务器
+                    self.queue.put_nowait(item)
+                    await asyncio.sleep(self.yield_delay)
+                    continue
 
+                items += await self.get_batch_items(server, item)
+                request = self.make_request(server, items)
+                # 等待限流不计入请求耗时
+                await self.acquire_rate_limit(server, request)
+                requested = True
+                self.scheduler.start(server_name)
+                start_time = time.perf_counter()
+                success = False
+                try:
+                    if len(items) > 1:
+                        success = await self.process_batch(server, items, request)
+                    else:
+                        # 被备份请求抢先完成时不记录耗时
+                        success = await self.process_item_hedgeable(server, item, request)
+                finally:
+                    elapsed = time.perf_counter() - start_time
+                    self.scheduler.finish(
+                        server_name,
+                        elapsed,
+                        sum(len(_item[1]) for _item in items),
+                        success,
+                    )
+                    if success:
+                        REQUEST_SECONDS.labels(server_name).observe(elapsed)
+                breaker.record_success()
+
+            except asyncio.CancelledError:
+                for _item in items:
+                    self.requeue(_item)
+                raise
             except client_exceptions.ClientConnectorError:
-                break
+                logger.warn(f"[{text}] put back to queue.")
+                for _item in items:
+                    self.requeue(_item)
+                RETRIES.labels(server_name, "disconnect").inc(len(items))
+                return
             except Exception as e:
-                logger.error(f"Error in server {server.config.server_name}: {e}")
-                break
+                for _item in items:
+                    self.requeue(_item)
+                RETRIES.labels(server_name, type(e).__name__).inc(len(items))
+                if is_transient_error(e):
+                    delay = breaker.record_failure(getattr(e, "retry_after", None))
+                    retry_msg = f", pause {delay:.1f}s" if delay else ""
+                    logger.warn(
+                        f"Server [{server_name}] {e!r}{retry_msg}, [{text}] put back to queue."
+                    )
+                    continue
+                logger.error(f"Error in server {server_name}: {e!r}")
+                logger.warn(f"[{text}] put back to queue.")
+                return
+            finally:
+                if is_probe and not requested:
+                    breaker.release_probe()
+                for _ in items:
+                    self.queue.task_done()
+
+    def requeue(self, item: tuple) -> bool:
+        """失败或结果不可用时放回队列重新翻译
+
+        已经有结果, 或者还有其他请求 (原请求或备份请求) 正在处理的文本不放回,
+        避免同一文本同时有多个请求; 那个请求失败时会自己放回队列
+        """
+        text_hash = self.item_key(item)
+        if text_hash in self.result_data:
+            return False
+        inflight = self.inflight_data.get(text_hash)
+        if inflight is not None:
+            current_task = asyncio.current_task()
+            if any(task is not current_task for task in inflight["tasks"]):
+                return False
+        self.queue.put_nowait(item)
+        return True
+
+    async def process_item_hedgeable(
+        self,
+        server: QueueServers,
+        item: tuple,
+        request: COMPLETION_REQUEST,
+        is_hedge: bool = False,
+    ) -> bool:
+        """在单独的任务中请求, 同一文本的原请求和备份请求先完成的一方取消另一方
+
+        返回结果是否由这次请求得到, 被取消或模型原样返回原文时为 False
+        """
+        text_hash = self.item_key(item)
+        inflight = self.inflight_data.get(text_hash)
+        if is_hedge and inflight is None:
+            return False
+
+        task = asyncio.ensure_future(self.process_item(server, item, request))
+        if inflight is None:
+            inflight = {
+                "start_time": time.perf_counter(),
+                "server_name": server.config.server_name,
+                "item": item,
+                "tasks": [],
+                "hedged": False,
+            }
+            self.inflight_data[text_hash] = inflight
+        inflight["tasks"].append(task)
+
+        try:
+            # asyncio.wait 在 task 被另一方取消时不会抛出异常
+            await asyncio.wait([task])
+        except asyncio.CancelledError:
+            task.cancel()
+            raise
+        finally:
+            inflight["tasks"].remove(task)
+            if text_hash in self.result_data:
+                for other_task in inflight["tasks"]:
+                    other_task.cancel()
+                self.inflight_data.pop(text_hash, None)
+            elif not inflight["tasks"]:
+                self.inflight_data.pop(text_hash, None)
+
+        if task.cancelled():
+            return False
+        return task.result()
+
+    async def hedge_worker(self, server: QueueServers):
+        server_name = server.config.server_name
+        while True:
+            await asyncio.sleep(self.hedge_interval)
+            if (
+                not self.queue.empty()
+                or not self.scheduler.is_idle(server_name)
+                or self.get_breaker(server_name).state != BreakerState.CLOSED
+            ):
+                continue
+
+            threshold = self.scheduler.latency_percentile(self.hedge_percentile)
+            if threshold is None:
+                continue
+            threshold = max(threshold, self.hedge_min_delay)
+
+            now = time.perf_counter()
+            straggler = next(
+                (
+                    inflight
+                    for inflight in self.inflight_data.values()
+                    if inflight["server_name"] != server_name
+                    and not inflight["hedged"]
+                    and now - inflight["start_time"] > threshold
+                ),
+                None,
+            )
+            if straggler is None:
+                continue
+
+            straggler["hedged"] = True
+            item = straggler["item"]
+            logger.warn(
+                f"[{item[1]}] on server [{straggler['server_name']}] takes {now - straggler['start_time']:.1f}s, hedge to [{server_name}]"
+            )
+            request = self.make_request(server, [item])
+            await self.acquire_rate_limit(server, request)
+            self.scheduler.start(server_name)
+            start_time = time.perf_counter()
+            success = False
+            try:
+                success = await self.process_item_hedgeable(server, item, request, True)
+            except asyncio.CancelledError:
+                self.requeue(item)
+                raise
+            except Exception as e:
+                # 原请求已经失败时由这里放回队列
+                self.requeue(item)
+                if is_transient_error(e):
+                    self.get_breaker(server_name).record_failure(
+                        getattr(e, "retry_after", None)
+                    )
+                logger.error(f"Hedge request error in server {server_name}: {e!r}")
             finally:
+                self.scheduler.finish(
+                    server_name, time.perf_counter() - start_time, len(item[1]), success
+                )
+
+    async def get_batch_items(self, server: QueueServers, first_item: tuple) -> list[tuple]:
+        """从队列中取出可以和 first_item 合并到同一个请求里的短文本"""
+        batch_size = server.config.batch_size
+        if batch_size <= 1:
+            return []
+
+        make_content, text, _, is_strictest = first_item
+        budget = server.config.batch_max_chars - len(text)
+        items = []
+        while len(items) + 1 < batch_size and not self.queue.empty():
+            item = self.queue.get_nowait()
+            _make_content, _text, _, _is_strictest = item
+            if (
+                _make_content != make_content
+                or _is_strictest != is_strictest
+                or len(_text) > budget
+            ):
+                # 不能合并, 放回队列
+                self.queue.put_nowait(item)
+                self.queue.task_done()
+                break
+            _text_hash = self.item_key(item)
+            if _text_hash in self.result_data:
+                with self.result_lock:
+                    self.store_result(_text_hash, self.result_data[_text_hash])
+                self.queue.task_done()
+                continue
+            if await self.lookup_memory(server, item):
                 self.queue.task_done()
+                continue
+            budget -= len(_text)
+            items.append(item)
+        return items
 
-        logger.error(f"Server [{server.config.server_name}] is disconnected.")
+    @staticmethod
+    def merge_gpt_prompt_list(items: list[tuple]) -> list[dict]:
+        """合并多条文本的术语表, 去掉重复的术语"""
+        if len(items) == 1:
+            return items[0][2]
+
+        gpt_prompt_list = []
+        gpt_prompt_src = set()
+        for item in items:
+            for gpt_prompt in item[2]:
+                if gpt_prompt["src"] not in gpt_prompt_src:
+                    gpt_prompt_src.add(gpt_prompt["src"])
+                    gpt_prompt_list.append(gpt_prompt)
+        return gpt_prompt_list
+
+    def make_request(self, server: QueueServers, items: list[tuple]) -> COMPLETION_REQUEST:
+        """构造一个或多个文本合并后的请求"""
+        make_content = items[0][0]
+        text = "\n".join(item[1] for item in items)
+        gpt_prompt_list = self.merge_gpt_prompt_list(items)
+
+        base_payload = {
+            "stream": False,
+            "max_tokens": 512,
+            "temperature": 0.1,
+            "top_p": 0.3,
+            "frequency_penalty": 0.05,
+        }
+
+        if server.api.server_type != "default":
+            message = QueueTextGenerationAPI.make_chat_completions_content(
+                japanese_normalize_cached(text), gpt_prompt_list
+            )
+            payload = {
+                "model": server.api.model_name,
+                "messages": [message],
+            }
+            prompt = message["content"]
+        else:
+            payload = {
+                "prompt": make_content(japanese_normalize_cached(text), gpt_prompt_list),
+                "top_k": 40,
+                "repetition_penalty": 1,
+                "do_sample": True,
+                "num_beams": 1,
+            }
+            prompt = payload["prompt"]
+        payload.update(base_payload)
+
+        prompt_tokens = estimate_tokens(prompt)
+        # 输出的长度按和原文差不多估计
+        return COMPLETION_REQUEST(payload, prompt_tokens, prompt_tokens + estimate_tokens(text))
+
+    async def acquire_rate_limit(self, server: QueueServers, request: COMPLETION_REQUEST):
+        rate_limiter = self.get_rate_limiter(server.config)
+        if rate_limiter.enabled:
+            await rate_limiter.acquire(request.tokens)
+
+    async def request_completion(
+        self, server: QueueServers, request: COMPLETION_REQUEST
+    ) -> str:
+        """发送请求, 调用方需先通过 acquire_rate_limit 获取限流令牌"""
+        if server.api.server_type != "default":
+            res_text = await server.api.openai_chat_completions(request.payload)
+        else:
+            res_text = await server.api.openai_completions(request.payload)
+        self.count_tokens(server, request.prompt_tokens, res_text)
+        return res_text
 
-        await server.api.close_session()
-        self.servers.remove(server)
-        logger.warn(f"[{text}] put back to queue.")
-        self.queue.put((make_content, text, gpt_prompt_list, is_strictest))
-        await self.wait_server_reconnect(server.config)
+    @staticmethod
+    def count_tokens(server: QueueServers, prompt_tokens: int, res_text: str):
+        TOKENS.labels(server.config.server_name, "in").inc(prompt_tokens)
+        TOKENS.labels(server.config.server_name, "out").inc(estimate_tokens(res_text or ""))
+
+    async def process_item(
+        self, server: QueueServers, item: tuple, request: COMPLETION_REQUEST = None
+    ) -> bool:
+        """request 为空时 (合并请求失败后逐行重试) 在这里构造请求并获取限流令牌
+
+        返回是否得到了结果, 模型原样返回原文 (放回队列重新翻译) 时为 False
+        """
+        text = item[1]
+
+        # logger.info(f"{self.queue.qsize()} [{server.config.server_name}] -: {text}")
+
+        if request is None:
+            request = self.make_request(server, [item])
+            await self.acquire_rate_limit(server, request)
+        res_text = await self.request_completion(server, request)
+
+        if server.api.server_type != "default":
+            if text == res_text:
+                # 模型原样返回了原文, 重新翻译
+                REJECTED_OUTPUTS.labels(server.config.server_name, "unchanged").inc()
+                self.requeue(item)
+                return False
+
+            res_text_split = res_text.split("\n")
+            if len(res_text_split) > 1:
+                res_text = res_text_split[-1]
+
+            res_text = res_text.replace("“", "").replace("”", "")
+
+        self.set_result(server, item, res_text)
+        return True
+
+    async def process_batch(
+        self, server: QueueServers, items: list[tuple], request: COMPLETION_REQUEST
+    ) -> bool:
+        """多行文本合并成一个请求, 按行拆分结果, 行数对不上时逐行重新请求
+
+        返回是否每一行都得到了结果
+        """
+        texts = [item[1] for item in items]
+        success = True
+
+        res_text = await self.request_completion(server, request)
+        res_lines = [line for line in res_text.splitlines() if line.strip()]
+
+        if len(res_lines) != len(texts):
+            RETRIES.labels(server.config.server_name, "batch_mismatch").inc(len(items))
+            logger.warn(
+                f"batch result lines [{len(res_lines)}] != [{len(texts)}], fallback to single line"
+            )
+            for item in items:
+                if self.item_key(item) not in self.result_data:
+                    success &= await self.process_item(server, item)
+            return success
+
+        for item, res_line in zip(items, res_lines):
+            text = item[1]
+            if server.api.server_type != "default":
+                if text == res_line:
+                    success &= await self.process_item(server, item)
+                    continue
+                res_line = res_line.replace("“", "").replace("”", "")
+            self.set_result(server, item, res_line)
+        return success
+
+    def get_memory_fingerprint(
+        self,
+        server: QueueServers,
+        make_content: Callable,
+        gpt_prompt_list: list[dict],
+        is_strictest: bool,
+    ) -> str:
+        """同一个模型, 提示词模板, 术语表和标点处理方式下的翻译结果才能复用"""
+        if server.api.server_type != "default":
+            template = self.make_chat_completions_content("")["content"]
+        else:
+            template = make_content("")
+        glossary = "\n".join(f"{p['src']}->{p['dst']}" for p in gpt_prompt_list or [])
+        parts = [server.api.server_type, server.api.model_name, template, glossary]
+        # is_strictest 的译文去掉了句末标点, 不加标记时与之前保存的记录兼容
+        if is_strictest:
+            parts.append("strictest")
+        return TranslationMemory.make_fingerprint(*parts)
+
+    async def lookup_memory(self, server: QueueServers, item: tuple) -> bool:
+        if self.translation_memory is None:
+            return False
+
+        make_content, text, gpt_prompt_list, is_strictest = item
+        fingerprint = self.get_memory_fingerprint(
+            server, make_content, gpt_prompt_list, is_strictest
+        )
+        # 导入的记录没有经过术语表和 is_strictest 的处理, 只用于普通请求
+        shared = not gpt_prompt_list and not is_strictest
+        # 查询 SQLite 放到线程中, 不阻塞 worker 事件循环
+        res_text = await asyncio.to_thread(
+            self.translation_memory.get, text, fingerprint, shared
+        )
+        if res_text is None:
+            CACHE_LOOKUPS.labels("memory", "miss").inc()
+            return False
+        CACHE_LOOKUPS.labels("memory", "hit").inc()
+
+        with self.result_lock:
+            self.store_result(self.item_key(item), res_text)
+        logger.info(f"{self.queue.qsize()} [{text}] found in translation memory.")
+        return True
+
+    def set_result(self, server: QueueServers, item: tuple, res_text: str):
+        make_content, text, gpt_prompt_list, is_strictest = item
+        text_hash = self.item_key(item)
+
+        if is_strictest:
+            for end in ["。", "？", "！", "，", "—", "…"]:
+                if res_text.endswith(end):
+                    res_text = res_text.rstrip(end)
+                    break
+
+        if not text.endswith("。") and res_text.endswith("。"):
+            res_text = res_text.rstrip("。")
+
+        with self.result_lock:
+            # 备份请求和原请求同时返回时只保存先到的结果
+            if text_hash in self.result_data:
+                return
+
+            if len(res_text) > 500:
+                # 输出过长一般是模型在重复输出, 截断到原文长度
+                REJECTED_OUTPUTS.labels(server.config.server_name, "too_long").inc()
+                res_text = res_text[: len(text)]
+                text_list = list(text)
+                text_list.reverse()
+                text_end = []
+                for char in text_list:
+                    if not has_japanese(char):
+                        text_end.append(char)
+                    else:
+                        break
+                text_end.reverse()
+                res_text += "".join(text_end)
+
+            self.store_result(text_hash, res_text)
+            TRANSLATED_LINES.labels(server.config.server_name).inc()
+            # logger.info(f"[{server.config.server_name}] +: {res_text}")
+            # fmt: off
+            logger.info(f"{self.queue.qsize()} \033[0m(\033[36m{server.config.server_name}\033[0m) [ \033[0;33m{text}\033[0m ] -> [ \033[35m{res_text}\033[0m ]")
+            # fmt: on
+
+        if self.translation_memory is not None:
+            fingerprint = self.get_memory_fingerprint(
+                server, make_content, gpt_prompt_list, is_strictest
+            )
+            # 只写入内存缓冲区, 由 TranslationMemory 的后台线程批量提交
+            self.translation_memory.set(text, res_text, fingerprint)
 
     async def wait_server_reconnect(self, openai_config: OpenAiServer):
+        attempt = 0
         while True:
+            qs = None
             try:
                 if qs := await self.connect_server(openai_config):
                     await self.servers_load_default_model(qs)
 
+                    self.get_breaker(openai_config.server_name).record_success()
                     self.start_server(qs)
                     logger.info(f"Server [{openai_config.server_name}] is reconnected.")
                     break
@@ -366,11 +969,21 @@ class QueueTextGenerationAPI:
             except Exception as e:
                 logger.error(f"Error in server [{openai_config.server_name}]: {e}")
 
+            if qs is not None:
+                # 连接成功但加载模型失败, 关闭这次的 session, 下次重新连接
+                await self.disconnect_server(qs)
+
             # logger.warn(f"Wait for server [{openai_config.server_name}] to reconnect...")
-            await asyncio.sleep(5)
+            await asyncio.sleep(backoff_delay(attempt, 5, 60))
+            attempt += 1
 
     async def servers_load_default_model(
         self, server: OpenAiServer = None, no_log=False
+    ):
+        await self.run_in_worker_loop(self._servers_load_default_model(server, no_log))
+
+    async def _servers_load_default_model(
+        self, server: OpenAiServer = None, no_log=False
     ):
         servers = [server] if server else self.servers
 
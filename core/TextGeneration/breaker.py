@@ -0,0 +1,130 @@
+import time
+import random
+import asyncio
+
+from enum import Enum
+from aiohttp import client_exceptions
+
+from utils.session import HTTPStatusError, HTTPTimeoutError
+
+
+class BreakerState(Enum):
+    CLOSED = "closed"
+    OPEN = "open"
+    HALF_OPEN = "half_open"
+
+
+def backoff_delay(attempt: int, base_delay: float = 1, max_delay: float = 60) -> float:
+    """带随机抖动的指数退避, 避免多个请求同时重试"""
+    delay = min(max_delay, base_delay * 2**attempt)
+    return delay * random.uniform(0.5, 1)
+
+
+def is_transient_error(e: Exception) -> bool:
+    """限流, 超时, 服务器错误和连接被中断都是暂时的, 稍后重试即可
+
+    无法连接服务器 (ClientConnectorError) 不算, 按服务器断开处理
+    """
+    if isinstance(e, client_exceptions.ClientConnectorError):
+        return False
+    if isinstance(e, HTTPStatusError):
+        return e.transient
+    return isinstance(
+        e,
+        (
+            HTTPTimeoutError,
+            asyncio.TimeoutError,
+            client_exceptions.ServerDisconnectedError,
+            client_exceptions.ClientOSError,
+            client_exceptions.ClientPayloadError,
+        ),
+    )
+
+
+class CircuitBreaker:
+    """单台服务器的熔断器
+
+    closed: 正常请求, 连续失败 failure_threshold 次后进入 open
+    open: 暂停请求, 等待退避时间 (或 Retry-After) 后进入 half_open
+    half_open: 只放行一个试探请求, 成功后恢复 closed, 失败则重新 open 并加倍等待时间
+
+    只在 worker 所在的事件循环中使用, 不需要加锁
+    """
+
+    def __init__(
+        self,
+        failure_threshold: int = 5,
+        base_delay: float = 1,
+        max_delay: float = 60,
+    ):
+        self.failure_threshold = failure_threshold
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+        self.state = BreakerState.CLOSED
+        self.failures = 0
+        # 连续 open 的次数, 决定退避时间
+        self.open_count = 0
+        self.open_until = 0.0
+        self.probing = False
+
+    async def acquire(self) -> bool:
+        """等待可以发送请求, 返回这次请求是否是 half_open 状态下的试探请求"""
+        while True:
+            if self.state == BreakerState.CLOSED:
+                return False
+
+            if self.state == BreakerState.OPEN:
+                wait_time = self.open_until - time.monotonic()
+                if wait_time > 0:
+                    await asyncio.sleep(wait_time)
+                    continue
+                self.state = BreakerState.HALF_OPEN
+
+            if not self.probing:
+                self.probing = True
+                return True
+            await asyncio.sleep(self.base_delay)
+
+    def can_request(self) -> bool:
+        """现在是否能马上发出请求: closed, 或者退避已结束且试探请求还没有被占用"""
+        if self.state == BreakerState.CLOSED:
+            return True
+        if self.state == BreakerState.OPEN and self.open_until > time.monotonic():
+            return False
+        return not self.probing
+
+    def release_probe(self):
+        """试探请求没有真正发出 (例如命中缓存) 时让出试探机会"""
+        self.probing = False
+
+    def record_success(self):
+        self.state = BreakerState.CLOSED
+        self.failures = 0
+        self.open_count = 0
+        self.probing = False
+
+    def record_failure(self, retry_after: float = None) -> float:
+        """记录一次失败, 返回进入 open 后需要等待的秒数, 仍为 closed 时返回 0"""
+        self.failures += 1
+        self.probing = False
+        if (
+            self.state == BreakerState.CLOSED
+            and self.failures < self.failure_threshold
+            and retry_after is None
+        ):
+            return 0
+
+        if self.state == BreakerState.OPEN:
+            # 其他并发请求已经触发了熔断
+            if retry_after is not None:
+                self.open_until = max(self.open_until, time.monotonic() + retry_after)
+            return max(0.0, self.open_until - time.monotonic())
+
+        delay = backoff_delay(self.open_count, self.base_delay, self.max_delay)
+        if retry_after is not None:
+            # 服务器指定了等待时间时以它为准
+            delay = max(delay, retry_after)
+        self.open_count += 1
+        self.state = BreakerState.OPEN
+        self.open_until = time.monotonic() + delay
+        return delay
@@ -0,0 +1,129 @@
+from collections import deque
+from threading import Lock
+
+
+class ServerStats:
+    """单台服务器的统计信息, 延迟和吞吐量使用指数加权移动平均 (EWMA)"""
+
+    __slots__ = ("concurrency", "inflight", "latency", "chars_per_sec")
+
+    def __init__(self, concurrency: int = 1):
+        self.concurrency = max(1, concurrency)
+        # 正在处理的请求数
+        self.inflight = 0
+        # 每个请求的耗时 (秒)
+        self.latency: float = None
+        # 每秒处理的原文字符数, 近似代替 tokens/s
+        self.chars_per_sec: float = None
+
+    def expected_time(self, chars: int) -> float | None:
+        """预计处理完一条 chars 长度的文本需要的时间, 没有统计数据时返回 None"""
+        if self.latency is None:
+            return None
+        cost = chars / self.chars_per_sec if self.chars_per_sec else self.latency
+        # 所有并发都在忙时需要等前面的请求
+        return cost * (1 + self.inflight / self.concurrency)
+
+
+class LatencyScheduler:
+    """根据每台服务器的延迟和吞吐量决定由谁处理队列中的文本
+
+    队列较长时所有服务器都取任务; 队列快空时, 如果其他服务器处理完剩余任务比自己处理一条还快,
+    慢服务器就不再取任务, 避免最后几条文本卡在慢服务器上
+    """
+
+    def __init__(self, alpha: float = 0.2, tolerance: float = 1.5):
+        # EWMA 中新样本的权重
+        self.alpha = alpha
+        # 自己的预计时间不超过其他服务器清空队列时间的多少倍时才取任务
+        self.tolerance = tolerance
+        self.stats: dict[str, ServerStats] = {}
+        # 最近成功请求的耗时, 用于计算分位数
+        self.recent_latency: deque[float] = deque(maxlen=200)
+        self.lock = Lock()
+
+    def register(self, server_name: str, concurrency: int):
+        # 重连后保留之前的统计数据
+        with self.lock:
+            stats = self.stats.setdefault(server_name, ServerStats(concurrency))
+            stats.concurrency = max(1, concurrency)
+            stats.inflight = 0
+
+    def start(self, server_name: str):
+        with self.lock:
+            self.stats[server_name].inflight += 1
+
+    def finish(self, server_name: str, elapsed: float, chars: int, success=True):
+        with self.lock:
+            stats = self.stats[server_name]
+            stats.inflight = max(0, stats.inflight - 1)
+            if not success or elapsed <= 0:
+                return
+
+            self.recent_latency.append(elapsed)
+            chars_per_sec = chars / elapsed
+            if stats.latency is None:
+                stats.latency = elapsed
+                stats.chars_per_sec = chars_per_sec
+            else:
+                stats.latency += self.alpha * (elapsed - stats.latency)
+                stats.chars_per_sec += self.alpha * (chars_per_sec - stats.chars_per_sec)
+
+    def should_take(
+        self, server_name: str, chars: int, queue_size: int, server_names: list[str]
+    ) -> bool:
+        """server_name 是否应该处理这条文本, queue_size 为队列中剩余的任务数
+
+        比较自己处理这条文本的预计时间和其他服务器处理完队列中所有任务 (包括这条) 的预计时间
+        """
+        with self.lock:
+            stats = self.stats.get(server_name)
+            if stats is None:
+                return True
+
+            expected_time = stats.expected_time(chars)
+            if expected_time is None:
+                # 还没有统计数据, 先处理一条
+                return True
+
+            # 其他服务器每秒能处理多少条这样的文本, 以及其中最快的一台处理一条的时间
+            others_rate = 0
+            best_time = None
+            for name in server_names:
+                other = self.stats.get(name)
+                if name == server_name or other is None:
+                    continue
+                other_time = other.expected_time(chars)
+                if other_time:
+                    others_rate += other.concurrency / other_time
+                    best_time = other_time if best_time is None else min(best_time, other_time)
+            if best_time is None:
+                return True
+
+            # 剩余任务再少也至少要一个请求的时间, 保证最快的服务器总会取任务
+            drain_time = max(best_time, (queue_size + 1) / others_rate)
+            return expected_time <= drain_time * self.tolerance
+
+    def is_idle(self, server_name: str) -> bool:
+        with self.lock:
+            stats = self.stats.get(server_name)
+            return stats is not None and stats.inflight < stats.concurrency
+
+    def latency_percentile(self, percentile: float, min_samples: int = 10) -> float | None:
+        """最近请求耗时的分位数, 样本太少时返回 None"""
+        with self.lock:
+            if len(self.recent_latency) < min_samples:
+                return None
+            latency = sorted(self.recent_latency)
+        return latency[min(len(latency) - 1, int(len(latency) * percentile))]
+
+    def summary(self) -> dict[str, dict]:
+        with self.lock:
+            return {
+                name: {
+                    "inflight": stats.inflight,
+                    "latency": stats.latency,
+                    "chars_per_sec": stats.chars_per_sec,
+                }
+                for name, stats in self.stats.items()
+            }
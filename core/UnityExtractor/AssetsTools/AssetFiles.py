@@ -0,0 +1,39 @@
+"""查找游戏目录中的资源文件, 不依赖 pythonnet, 可以单独使用"""
+from enum import IntEnum
+from pathlib import Path
+
+from UnityPy.helpers.ImportHelper import check_file_type
+
+
+class FileType(IntEnum):
+    AssetsFile = 0
+    BundleFile = 1
+    WebFile = 2
+    ResourceFile = 9
+    ZIP = 10
+
+
+EXCLUDE_SUFFIX = [
+    ".resS",
+    ".resource",
+    ".config",
+    ".xml",
+    ".dat",
+    ".info",
+    ".dll",
+    ".json",
+]
+
+
+def iter_asset_files(directory: str | Path):
+    """生成目录下所有 AssetsFile 和 BundleFile 的 (file_type, 文件绝对路径)"""
+    directory = directory if isinstance(directory, Path) else Path(directory)
+    if directory.is_file():
+        directory = directory.parent
+
+    for file in directory.rglob("*"):
+        if file.is_file() and file.suffix not in EXCLUDE_SUFFIX:
+            with file.open("rb") as f:
+                file_type, reader = check_file_type(f)
+            if file_type == FileType.AssetsFile or file_type == FileType.BundleFile:
+                yield file_type, str(file.resolve())
@@ -4,27 +4,19 @@ import ujson as json
 
 import clr
 
-from enum import IntEnum
 from pathlib import Path
 from collections import namedtuple, defaultdict
 
 from tqdm import tqdm
 
-from utils import logger, get_ecx_path
+from utils import logger, get_ecx_path, get_text_data_path, update_objects_by_paths
 
 from .AssetClassID import AssetClassID
+from .AssetFiles import FileType, EXCLUDE_SUFFIX, iter_asset_files
 
 CS_RUNTIME_DIR = get_ecx_path("runtime")
 
 
-class FileType(IntEnum):
-    AssetsFile = 0
-    BundleFile = 1
-    WebFile = 2
-    ResourceFile = 9
-    ZIP = 10
-
-
 Cpp2IL_RUNTIME_DIR = os.path.join(CS_RUNTIME_DIR, "Cpp2IL")
 MonoCecil_RUNTIME_DIR = os.path.join(CS_RUNTIME_DIR, "MonoCecil")
 
@@ -32,8 +24,6 @@ CLASSDATATPK_DIR = os.path.join(CS_RUNTIME_DIR, "classdata.tpk")
 
 Path_str = lambda p: str(p.resolve()) if isinstance(p, Path) else p
 
-from UnityPy.helpers.ImportHelper import check_file_type
-
 
 def get_all_assets_files(data_dir: Path):
     files = []
@@ -58,33 +48,13 @@ def get_all_assets_files(data_dir: Path):
     return files
 
 
-EXCLUDE_SUFFIX = [
-    ".resS",
-    ".resource",
-    ".config",
-    ".xml",
-    ".dat",
-    ".info",
-    ".dll",
-    ".json",
-]
-
-
 # from System.IO import MemoryStream
 from System.IO import File
 
 
 def get_all_files(directory: str | Path, open_file=True):
-    directory = directory if isinstance(directory, Path) else Path(directory)
-    if directory.is_file():
-        directory = directory.parent
-    
-    for file in directory.rglob("*"):
-        if file.is_file() and file.suffix not in EXCLUDE_SUFFIX:
-            with file.open("rb") as f:
-                file_type, reader = check_file_type(f)
-            if file_type == FileType.AssetsFile or file_type == FileType.BundleFile:
-                yield file_type, File.OpenRead(str(file)) if open_file else None, str(file.resolve())
+    for file_type, file in iter_asset_files(directory):
+        yield file_type, File.OpenRead(file) if open_file else None, file
 
 
 def pythonnet_init(is_MonoCecil=False):
@@ -131,6 +101,8 @@ Assets = namedtuple("Assets", "file_inst asset_name file_path file_name_fix")
 class AssetsTools:
     __intense__ = None
     resource_is_loaded = False
+    # 找不到 MonoScript (所在文件没有加载) 而跳过的 MonoBehaviour 数
+    unresolved_scripts = 0
 
     game_data_dir: Path
 
@@ -349,8 +321,13 @@ class AssetsTools:
         assets_type = self.AT.AssetClassID(asset_classId.value)
         return file_inst.file.GetAssetsOfType(assets_type)
 
-    def dump_monobehaviour(self, as_json: bool = False, handler: callable = None):
-        script_obj = {}
+    def iter_monobehaviour(
+        self, as_json: bool = False, handler: callable = None, file_paths: set[str] = None
+    ):
+        """逐个导出 MonoBehaviour 和 TextAsset, 每次生成一个 FieldsInfo
+
+        file_paths 不为空时只导出这些文件中的资源, 其他已加载的文件只用于解析跨文件的 MonoScript 引用
+        """
 
         def dump_script(asset: Assets, go_base):
             
@@ -380,6 +357,10 @@ class AssetsTools:
                     scriptBaseField = self.manager.GetExtAsset(asset.file_inst, goBase["m_Script"]).baseField
 
                     if scriptBaseField is None:
+                        self.unresolved_scripts += 1
+                        logger.warn(
+                            f"MonoScript not loaded, skip:{asset.file_path} PathId:[{goInfo.PathId}]"
+                        )
                         continue
 
                     class_name = scriptBaseField["m_Name"].AsString
@@ -404,16 +385,16 @@ class AssetsTools:
                 if as_json:
                     fi = fi._asdict()
 
-                if script_obj.get(class_name) is None:
-                    script_obj[class_name] = [fi]
-                else:
-                    script_obj[class_name].append(fi)
+                yield fi
 
         for assets in self.assets.values():
             if assets.asset_name == "globalgamemanagers.assets":
                 self.load_resources(file_inst=assets.file_inst)
                 continue
-            
+
+            if file_paths is not None and assets.file_path not in file_paths:
+                continue
+
             MonoBehaviour = self.filter_type(
                 assets.file_inst, AssetClassID.MonoBehaviour
             )
@@ -425,10 +406,18 @@ class AssetsTools:
                 # total_info_num = len(TextAsset)
                 handler(total_info_num)
 
-            dump_script(assets, MonoBehaviour)
+            yield from dump_script(assets, MonoBehaviour)
             # dump_script(file_inst, MonoScript)
-            dump_script(assets, TextAsset)
+            yield from dump_script(assets, TextAsset)
 
+    def dump_monobehaviour(self, as_json: bool = False, handler: callable = None):
+        script_obj = {}
+        for fi in self.iter_monobehaviour(as_json, handler):
+            class_name = fi["class_name"] if as_json else fi.class_name
+            if script_obj.get(class_name) is None:
+                script_obj[class_name] = [fi]
+            else:
+                script_obj[class_name].append(fi)
         return script_obj
 
     def update_monobehaviour(self, update_script_obj: dict):
@@ -478,10 +467,15 @@ class AssetsTools:
 
                 with tqdm(total=len(assets), desc=f"update {cab_name}") as pbar:
                     path_cache = {}
+                    text_asset_updates = defaultdict(list)
+                    # 找不到 MonoScript 的对象, 同一个对象的多个字段只提示一次
+                    skipped_path_ids = set()
 
                     for _script_obj in assets:
                         pbar.update(1)
                         path_id = _script_obj["info"]["path_id"]
+                        if path_id in skipped_path_ids:
+                            continue
                         
                         if path_cache.get(path_id) is not None:
                             goInfo, goBase = path_cache[path_id]
@@ -495,6 +489,10 @@ class AssetsTools:
                                 scriptBaseField = self.manager.GetExtAsset(afileInst, goBase["m_Script"]).baseField
 
                                 if scriptBaseField is None:
+                                    skipped_path_ids.add(path_id)
+                                    logger.warn(
+                                        f"MonoScript not loaded, skip update:{file_path} PathId:[{path_id}]"
+                                    )
                                     continue
 
                             path_cache[path_id] = (goInfo, goBase)
@@ -505,44 +503,10 @@ class AssetsTools:
                         #     continue
                         
                         if goBaseField.TypeName == "TextAsset":
-                            
-                            
-                            def update_str_obj(str_obj, paths, field, value):
-                                replace_obj = json.loads(str_obj)
-                                replace_obj_obj = replace_obj
-                                
-                                for _path in paths:
-                                    if "[" in _path and _path.endswith("]"):
-                                        _path_arr = _path.split("[")
-                                        for _index, _field in enumerate(_path_arr):
-                                            if field == "" and _path_arr[-1].endswith("]") and _index == len(_path_arr) - 1:
-                                                field = int(_field.rstrip("]"))
-                                            elif _field.endswith("]"):
-                                                replace_obj_obj = replace_obj_obj[int(_field.rstrip("]"))]
-                                            elif _field == "value":
-                                                continue
-                                            else:
-                                                replace_obj_obj = replace_obj_obj.get(_field)
-                                    elif isinstance(replace_obj_obj.get(_path), dict):
-                                        replace_obj_obj = replace_obj_obj.get(_path)
-                                
-                                replace_obj_obj[field] = value
-                                replace_text = json.dumps(replace_obj, ensure_ascii=False)
-                                return replace_text
-                            
-                            
-                            str_obj = goBaseField["m_Script"].AsString
-                            full_path = _script_obj["full_path"].split(".")[1:]
-                            field = _script_obj['field']
-                            value = _script_obj['value']
-                            
-                            if isinstance(_script_obj["info"]["value"], list):
-                                replace_text = update_str_obj(str_obj, full_path, field, value)
-                                goBaseField["m_Script"].AsString = replace_text
-                                continue
-                            elif isinstance(_script_obj["info"]["value"], dict):
-                                replace_text = update_str_obj(str_obj, full_path, field, value)
-                                goBaseField["m_Script"].AsString = replace_text
+                            if isinstance(_script_obj["info"]["value"], (list, dict)):
+                                # json 格式的 TextAsset 收集所有修改后只解析和序列化一次
+                                path = get_text_data_path(_script_obj)[1:]
+                                text_asset_updates[path_id].append((path, _script_obj["value"]))
                                 continue
                             
                             replace_text = _script_obj["value"]
@@ -550,17 +514,15 @@ class AssetsTools:
                                 goBaseField["m_Script"].AsString = replace_text
                                 continue
 
-                        _script_obj_full_path = _script_obj["full_path"].split(".")[2:]
-
-                        for _path in _script_obj_full_path:
-                            if "[" in _path and _path.endswith("]"):
-                                for _field in _path.split("["):
-                                    if _field.endswith("]"):
-                                        goBaseField = goBaseField[int(_field.rstrip("]"))]
-                                    else:
-                                        goBaseField = goBaseField[_field + ".Array"]
+                        # 第一段是 value, 数组字段的下一段是下标
+                        path = get_text_data_path(_script_obj)[1:]
+                        for index, component in enumerate(path):
+                            if isinstance(component, int):
+                                goBaseField = goBaseField[component]
+                            elif index + 1 < len(path) and isinstance(path[index + 1], int):
+                                goBaseField = goBaseField[component + ".Array"]
                             else:
-                                goBaseField = goBaseField[_path]
+                                goBaseField = goBaseField[component]
 
                         data_info = None
 
@@ -576,6 +538,12 @@ class AssetsTools:
                         if data_info.AsString != _script_obj["value"]:
                             data_info.AsString = _script_obj["value"]
 
+                    for path_id, updates in text_asset_updates.items():
+                        script_field = path_cache[path_id][1]["m_Script"]
+                        replace_obj = json.loads(script_field.AsString)
+                        update_objects_by_paths(replace_obj, updates)
+                        script_field.AsString = json.dumps(replace_obj, ensure_ascii=False)
+
                     for goInfo, goBase in path_cache.values():
                         goInfo.SetNewData(goBase)
 
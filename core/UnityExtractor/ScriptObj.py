@@ -0,0 +1,45 @@
+"""script_obj.jsonl 的读写, 不依赖 pythonnet, 可以单独使用"""
+import ujson as json
+
+from pathlib import Path
+
+from utils import iter_object_text, has_japanese
+
+SCRIPT_OBJ_FILE = "script_obj.jsonl"
+
+
+def write_script_obj_record(f, record: dict):
+    f.write(json.dumps(record, ensure_ascii=False) + "\n")
+
+
+def iter_script_obj(file_path: Path):
+    """逐条读取 script_obj.jsonl (每行一个 FieldsInfo), 生成 (parent_path, record)
+
+    parent_path 与旧版 script_obj.json 中的路径一致, 例如 ClassName[0],
+    script_obj.jsonl 不存在时读取旧版的 script_obj.json
+    """
+    if not file_path.exists():
+        legacy_file = file_path.with_suffix(".json")
+        if not legacy_file.exists():
+            return
+        with open(legacy_file, "r", encoding="utf-8") as f:
+            legacy_data = json.load(f)
+        for class_name, records in legacy_data.items():
+            for index, record in enumerate(records):
+                yield f"{class_name}[{index}]", record
+        return
+
+    class_index = {}
+    with open(file_path, "r", encoding="utf-8") as f:
+        for line in f:
+            record = json.loads(line)
+            class_name = record["class_name"]
+            index = class_index.get(class_name, 0)
+            class_index[class_name] = index + 1
+            yield f"{class_name}[{index}]", record
+
+
+def iter_script_obj_text(file_path: Path):
+    """逐条搜索 script_obj.jsonl 中含有日文的文本, 生成 iter_object_text 的结果"""
+    for parent_path, record in iter_script_obj(file_path):
+        yield from iter_object_text(record, has_japanese, parent_path=parent_path)
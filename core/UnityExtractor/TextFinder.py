@@ -1,15 +1,24 @@
+import os
+import shutil
 from pathlib import Path
 import ujson as json
 
 from tqdm import tqdm
+from concurrent.futures import ProcessPoolExecutor
 
 from UnityPy.export.Texture2DConverter import parse_image_data, TF
 from UnityPy.enums.BuildTarget import BuildTarget
 
-from utils import logger, find_unity_game_data_path, search_object_text, has_japanese
+from utils import logger, find_unity_game_data_path, file_md5
 
 from .AssetsTools.AssetsTools import AssetsTools, get_all_files, FileType
 from .AssetsTools.AssetClassID import AssetClassID
+from .ScriptObj import (
+    SCRIPT_OBJ_FILE,
+    write_script_obj_record,
+    iter_script_obj,
+    iter_script_obj_text,
+)
 
 
 def write_json(file_path, data, ensure_ascii=False, indent=4):
@@ -17,6 +26,20 @@ def write_json(file_path, data, ensure_ascii=False, indent=4):
         json.dump(data, f, ensure_ascii=ensure_ascii, indent=indent)
 
 
+def write_json_array(file_path: Path, items):
+    """逐个写入 json 数组, 每个元素一行, 不需要先把所有元素放进列表"""
+    temp_file = file_path.with_name(file_path.name + ".tmp")
+    with open(temp_file, "w", encoding="utf-8") as f:
+        f.write("[")
+        separator = "\n"
+        for item in items:
+            f.write(separator)
+            f.write(json.dumps(item, ensure_ascii=False))
+            separator = ",\n"
+        f.write("\n]\n")
+    os.replace(temp_file, file_path)
+
+
 def read_json(file_path):
     if not file_path.exists():
         return {}
@@ -25,6 +48,75 @@ def read_json(file_path):
     return data
 
 
+# 记录上次提取时每个资源文件的大小, 修改时间和内容 hash
+EXTRACT_MANIFEST_FILE = "extract_manifest.json"
+
+
+# 通常保存 MonoScript 的文件, 多进程提取时每个分片都会加载, 用于解析跨文件的 MonoScript 引用
+SCRIPT_DEPENDENCY_FILES = {"globalgamemanagers.assets", "resources.assets"}
+
+
+def get_script_dependency_files(
+    files: list[tuple[FileType, str]]
+) -> list[tuple[FileType, str]]:
+    """files 中可能保存 MonoScript 的文件, 包括 Addressables 打包的 monoscripts bundle"""
+    return [
+        (file_type, file)
+        for file_type, file in files
+        if Path(file).name in SCRIPT_DEPENDENCY_FILES
+        or (file_type == FileType.BundleFile and "monoscripts" in Path(file).name.lower())
+    ]
+
+
+# 每个子进程持有自己的 AssetsTools, 类型数据库只加载一次
+_worker_at: AssetsTools = None
+
+
+def _init_dump_worker(game_data_dir: Path):
+    global _worker_at
+    _worker_at = AssetsTools(game_data_dir)
+    if _worker_at.load_resources() is False:
+        logger.warn("resources not loaded, container is empty")
+
+
+def _dump_shard(
+    shard: tuple[list[tuple[FileType, str]], list[tuple[FileType, str]], Path]
+) -> tuple[Path, int]:
+    """加载分片中的文件和依赖文件, 只导出分片中的文件, 返回导出的文件和找不到 MonoScript 的数量"""
+    files, dependency_files, out_file = shard
+    at = _worker_at
+    at.assets.clear()
+    at.unresolved_scripts = 0
+    dump_paths = {file for _, file in files}
+    for file_type, file in files + [
+        dependency for dependency in dependency_files if dependency[1] not in dump_paths
+    ]:
+        if file_type == FileType.AssetsFile:
+            at.load_asset(file)
+        elif file_type == FileType.BundleFile:
+            at.load_asset_bundle(file)
+
+    with open(out_file, "w", encoding="utf-8") as f:
+        for fi in at.iter_monobehaviour(True, file_paths=dump_paths):
+            write_script_obj_record(f, fi)
+
+    # 释放已加载的文件, 保留类型数据库给下一个分片使用
+    at.assets.clear()
+    at.manager.UnloadAll(False)
+    return out_file, at.unresolved_scripts
+
+
+def make_shards(files: list[tuple[FileType, str]], shard_num: int) -> list[list]:
+    """按文件大小把文件分配到 shard_num 个分片, 尽量让每个分片大小接近"""
+    shards = [[] for _ in range(shard_num)]
+    shard_size = [0] * shard_num
+    for file_type, file in sorted(files, key=lambda f: -os.path.getsize(f[1])):
+        index = shard_size.index(min(shard_size))
+        shards[index].append((file_type, file))
+        shard_size[index] += os.path.getsize(file)
+    return [shard for shard in shards if shard]
+
+
 class TextFinder:
     game_path: Path
     game_data_dir: Path
@@ -32,8 +124,6 @@ class TextFinder:
 
     at: AssetsTools
 
-    script_obj: dict
-
     def __init__(self, game_path: Path):
 
         self.game_path = game_path
@@ -44,50 +134,198 @@ class TextFinder:
 
         self.at = AssetsTools(self.game_data_dir)
 
-    def load_assets_script_obj(self, use_cache=False):
-        cache_script_file = self.game_cache_data_dir / "script_obj.json"
-        if cache_script_file.exists() and use_cache:
-            logger.info("Loading cached script object")
-            with open(cache_script_file, "r", encoding="utf-8") as f:
-                script_obj = json.load(f)
-            self.script_obj = script_obj
-            return
-
-        asset_files = get_all_files(self.game_data_dir.parent)
+    def load_assets_script_obj(
+        self, use_cache=False, workers: int = 1, incremental=True
+    ) -> Path:
+        """导出所有 MonoBehaviour 和 TextAsset 到 script_obj.jsonl, 边导出边写入文件
+
+        incremental 为 True 时只重新导出新增或修改过的资源文件, 其他文件沿用上次导出的记录.
+        单进程模式下未修改的文件仍会加载, 用于解析跨文件的 MonoScript 引用
+        """
+        script_obj_file = self.game_cache_data_dir / SCRIPT_OBJ_FILE
+        if script_obj_file.exists() and use_cache:
+            logger.info("Using cached script object")
+            return script_obj_file
+
+        manifest_file = self.game_cache_data_dir / EXTRACT_MANIFEST_FILE
+        manifest = {}
+        if incremental and script_obj_file.exists():
+            manifest = read_json(manifest_file)
+
+        files = [
+            (file_type, file)
+            for file_type, _, file in get_all_files(self.game_data_dir.parent, False)
+        ]
+        changed_files, new_manifest = self.get_changed_files(files, manifest)
+
+        if manifest and not changed_files and new_manifest.keys() == manifest.keys():
+            logger.info("no asset files changed, using cached script object")
+            write_json(manifest_file, new_manifest)
+            return script_obj_file
+
+        temp_file = script_obj_file.with_name(script_obj_file.name + ".tmp")
+        with open(temp_file, "w", encoding="utf-8") as f:
+            if manifest:
+                changed_paths = {self.get_relative_path(file) for _, file in changed_files}
+                keep_paths = new_manifest.keys() - changed_paths
+                keep_num = 0
+                for _, record in iter_script_obj(script_obj_file):
+                    if record["file_path"] in keep_paths:
+                        write_script_obj_record(f, record)
+                        keep_num += 1
+                logger.info(
+                    f"{len(changed_files)}/{len(files)} files changed, keep {keep_num} dumped records"
+                )
+
+        if workers > 1:
+            self.dump_script_obj_sharded(
+                temp_file, changed_files, workers, get_script_dependency_files(files)
+            )
+        elif manifest:
+            self.dump_script_obj(temp_file, files, changed_files)
+        else:
+            self.dump_script_obj(temp_file, files)
+        temp_file.replace(script_obj_file)
+        # 导出完成后再写入 manifest, 中途失败时下次会重新导出
+        write_json(manifest_file, new_manifest)
+
+        # 旧版本整体写入的 script_obj.json 已不再使用
+        script_obj_file.with_suffix(".json").unlink(missing_ok=True)
+        return script_obj_file
+
+    def get_relative_path(self, file: str) -> str:
+        # 与 FieldsInfo.file_path 的格式一致
+        return str(Path(file).relative_to(self.game_data_dir.parent))
+
+    def get_changed_files(
+        self, files: list[tuple[FileType, str]], manifest: dict
+    ) -> tuple[list[tuple[FileType, str]], dict]:
+        """对比 manifest 找出新增或修改过的文件, 返回这些文件和新的 manifest
+
+        大小和修改时间都没变的文件直接认为没有修改, 否则再比较内容 hash
+        """
+        changed_files = []
+        new_manifest = {}
+        for file_type, file in tqdm(files, desc="checking asset files"):
+            relative_path = self.get_relative_path(file)
+            stat = os.stat(file)
+            fingerprint = {"size": stat.st_size, "mtime": stat.st_mtime_ns}
+            old_fingerprint = manifest.get(relative_path)
+
+            if (
+                old_fingerprint is not None
+                and old_fingerprint["size"] == fingerprint["size"]
+                and old_fingerprint["mtime"] == fingerprint["mtime"]
+            ):
+                new_manifest[relative_path] = old_fingerprint
+                continue
+
+            fingerprint["hash"] = file_md5(file)
+            new_manifest[relative_path] = fingerprint
+            if old_fingerprint is None or old_fingerprint["hash"] != fingerprint["hash"]:
+                changed_files.append((file_type, file))
+
+        return changed_files, new_manifest
+
+    def dump_script_obj(
+        self,
+        out_file: Path,
+        files: list[tuple[FileType, str]],
+        dump_files: list[tuple[FileType, str]] = None,
+    ):
+        """加载 files 中的所有文件, 导出 dump_files (为空时为全部文件) 中的资源"""
         logger.info("Loading resources..")
         if self.at.load_resources() is False:
             logger.warn("resources not loaded, container is empty")
 
-        for file_type, stream, file in tqdm(asset_files, desc="Loading assets"):
+        for file_type, file in tqdm(files, desc="Loading assets"):
             if file_type == FileType.AssetsFile:
-                self.at.load_asset(file, stream)
+                self.at.load_asset(file)
             elif file_type == FileType.BundleFile:
-                self.at.load_asset_bundle(file, stream)
-
-        pbar = tqdm(total=len(self.at.assets))
+                self.at.load_asset_bundle(file)
+
+        dump_paths = None
+        if dump_files is not None:
+            dump_paths = {file for _, file in dump_files}
+        pbar = tqdm(
+            total=sum(
+                1
+                for assets in self.at.assets.values()
+                if dump_paths is None or assets.file_path in dump_paths
+            )
+        )
 
         def process_assets(total_info_num):
             pbar.update()
             pbar.set_description(f"dumping {total_info_num} fields")
 
-        script_obj = self.at.dump_monobehaviour(True, process_assets)
-
-        # with open(cache_script_file, "w", encoding="utf-8") as f:
-        #     json.dump(script_obj, f, ensure_ascii=False)
-        write_json(cache_script_file, script_obj, indent=0)
-
-        self.script_obj = script_obj
+        self.at.unresolved_scripts = 0
+        with open(out_file, "a", encoding="utf-8") as f:
+            for fi in self.at.iter_monobehaviour(True, process_assets, dump_paths):
+                write_script_obj_record(f, fi)
+        pbar.close()
+
+        if self.at.unresolved_scripts:
+            logger.warn(
+                f"{self.at.unresolved_scripts} MonoBehaviours skipped, their MonoScript is not found"
+            )
+
+    def dump_script_obj_sharded(
+        self,
+        out_file: Path,
+        files: list[tuple[FileType, str]],
+        workers: int,
+        dependency_files: list[tuple[FileType, str]] = None,
+    ):
+        """多进程提取, 每个进程加载一部分资源文件并导出到单独的文件, 最后按顺序合并
+
+        每个分片都会加载 dependency_files 用于解析 MonoScript 引用, 但不导出其中的资源.
+        MonoScript 在其他文件中的 MonoBehaviour 无法导出, 会统计数量并提示使用单进程模式
+        """
+        # 分片比进程数多一些, 避免大文件集中在同一个进程
+        shards = make_shards(files, workers * 4)
+        logger.info(f"dumping {len(files)} files in {len(shards)} shards with {workers} workers")
+
+        shard_args = [
+            (shard, dependency_files or [], out_file.with_name(f"{out_file.name}.part{index}"))
+            for index, shard in enumerate(shards)
+        ]
+        unresolved_scripts = 0
+        with ProcessPoolExecutor(
+            max_workers=workers,
+            initializer=_init_dump_worker,
+            initargs=(self.game_data_dir,),
+        ) as executor, open(out_file, "ab") as f:
+            for part_file, unresolved in tqdm(
+                executor.map(_dump_shard, shard_args), total=len(shards), desc="dumping shards"
+            ):
+                with open(part_file, "rb") as part:
+                    shutil.copyfileobj(part, f)
+                part_file.unlink()
+                unresolved_scripts += unresolved
+
+        if unresolved_scripts:
+            logger.warn(
+                f"{unresolved_scripts} MonoBehaviours skipped, their MonoScript is in another shard, "
+                "use single process mode to dump them"
+            )
+
+    def dump_prepare_text(self, workers: int = 1, incremental=True):
+        script_obj_file = self.load_assets_script_obj(
+            workers=workers, incremental=incremental
+        )
 
-    def dump_prepare_text(self):
-        self.load_assets_script_obj()
-        text_data = search_object_text(self.script_obj, has_japanese)
         prepare_json_data = read_json(self.game_cache_data_dir / "prepare_text.json")
 
-        for data in text_data:
-            value = prepare_json_data.get(data["text"], "")
-            prepare_json_data[data["text"]] = value
+        def iter_text_data(pbar: tqdm):
+            for data in iter_script_obj_text(script_obj_file):
+                prepare_json_data.setdefault(data["text"], "")
+                pbar.update(1)
+                yield data
 
-        write_json(self.game_cache_data_dir / "text_data.json", text_data)
+        # 边搜索边写入, 不在内存中保存所有文本
+        with tqdm(desc="searching for text") as pbar:
+            write_json_array(self.game_cache_data_dir / "text_data.json", iter_text_data(pbar))
 
         write_json(self.game_cache_data_dir / "prepare_text.json", prepare_json_data)
 
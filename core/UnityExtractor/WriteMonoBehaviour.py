@@ -1,10 +1,11 @@
 import ujson as json
 
 from pathlib import Path
+from collections import defaultdict
 from tqdm import tqdm
 
-from utils import logger, find_object_by_str_path, update_object_by_str_path, str2md5
-from .TextFinder import TextFinder, write_json
+from utils import logger, update_object_by_str_path, text_data_hash, migrate_text_data
+from .TextFinder import TextFinder, write_json, iter_script_obj, SCRIPT_OBJ_FILE
 
 
 class WriteMonoBehaviour(TextFinder):
@@ -16,21 +17,35 @@ class WriteMonoBehaviour(TextFinder):
         super().__init__(game_path)
 
     def write_cache_to_file(self):
-        script_obj_file = self.game_cache_data_dir / "script_obj.json"
+        script_obj_file = self.game_cache_data_dir / SCRIPT_OBJ_FILE
         text_data_file = self.game_cache_data_dir / "text_data.json"
         prepare_text_file = self.game_cache_data_dir / "prepare_text.json"
 
         logger.info("loading cache data")
 
-        with open(script_obj_file, "r", encoding="utf-8") as f:
-            script_obj = json.load(f)
         with open(text_data_file, "r", encoding="utf-8") as f:
             text_data: list[dict] = json.load(f)
         with open(prepare_text_file, "r", encoding="utf-8") as f:
             prepare_text_data = json.load(f)
 
+        # 旧版本的 text_data.json 使用 md5, 结束时会写回迁移后的结果
+        if migrated := migrate_text_data(text_data):
+            logger.info(f"migrated {migrated} text hashes in text_data.json")
+
         update_script_obj = []
 
+        # 按原文 hash 和译文 hash 建立索引, 避免每条文本都扫描整个 text_data
+        text_hash_index: dict[str, list[dict]] = defaultdict(list)
+        value_hash_index: dict[str, list[dict]] = defaultdict(list)
+        for text_data_item in text_data:
+            text_hash_index[text_data_item["text_hash"]].append(text_data_item)
+            if "value_hash" in text_data_item:
+                value_hash_index[text_data_item["value_hash"]].append(text_data_item)
+
+        # 需要更新的 MonoBehaviour, 匹配完成后再从 script_obj.jsonl 中流式读取
+        script_obj_info: dict[str, dict] = {}
+        update_parent_paths = []
+
         with tqdm(total=len(prepare_text_data), desc="update script object") as pbar:
             for prepare_text, prepare_text_value in prepare_text_data.items():
                 pbar.update(1)
@@ -38,24 +53,35 @@ class WriteMonoBehaviour(TextFinder):
                     logger.warning(f"text [{prepare_text}] no value, skip")
                     continue
 
-                prepare_text_hash = str2md5(prepare_text)
-                value_hash = str2md5(prepare_text_value)
+                prepare_text_hash = text_data_hash(prepare_text)
+                value_hash = text_data_hash(prepare_text_value)
 
-                for text_data_item in text_data:
-                    if text_data_item["text_hash"] != prepare_text_hash:
-                        if text_data_item.get("value_hash", "") != value_hash:
-                            continue
+                matched_items = {}
+                for text_data_item in text_hash_index.get(prepare_text_hash, []):
+                    matched_items[id(text_data_item)] = text_data_item
+                for text_data_item in value_hash_index.get(value_hash, []):
+                    # 索引中可能还留着已经被改成其他译文的旧记录
+                    if text_data_item["value_hash"] == value_hash:
+                        matched_items[id(text_data_item)] = text_data_item
 
+                for text_data_item in matched_items.values():
                     parent_path = text_data_item["parent_path"].split(".")[0]
-                    script_obj_info = find_object_by_str_path(script_obj, parent_path)
+                    script_obj_info[parent_path] = None
 
                     text_data_item["value"] = prepare_text_value
-                    text_data_item["value_hash"] = value_hash
+                    if text_data_item.get("value_hash") != value_hash:
+                        text_data_item["value_hash"] = value_hash
+                        value_hash_index[value_hash].append(text_data_item)
+
+                    update_script_obj.append(text_data_item.copy())
+                    update_parent_paths.append(parent_path)
 
-                    update_monobehaviour_data = text_data_item.copy()
-                    update_monobehaviour_data["info"] = script_obj_info
+        for parent_path, record in tqdm(iter_script_obj(script_obj_file), desc="loading script object"):
+            if parent_path in script_obj_info:
+                script_obj_info[parent_path] = record
 
-                    update_script_obj.append(update_monobehaviour_data)
+        for update_monobehaviour_data, parent_path in zip(update_script_obj, update_parent_paths):
+            update_monobehaviour_data["info"] = script_obj_info[parent_path]
 
         write_json(self.game_cache_data_dir / "text_data.json", text_data)
         # logger.info("writing script object to file")
@@ -1,5 +1,6 @@
 import os
 import asyncio
+import multiprocessing
 import ujson as json
 
 from menu_tools import MenuTools
@@ -8,7 +9,7 @@ from pathlib import Path
 
 from tqdm import tqdm
 
-from utils import logger, get_ecx_path, has_japanese
+from utils import logger, get_ecx_path, has_japanese_batch, read_server_list
 from utils.arg_require import ArgRequire, ArgRequireOption
 
 
@@ -19,16 +20,31 @@ ag = ArgRequire(ArgRequireOption(save=True, save_path="config.ini"))
 
 last_game_path = None
 
+# 翻译时定时保存监控指标 (Prometheus 文本格式), 为 None 时不保存
+# 在 server-list.ini 的 [settings] 中设置 metrics_file 开启
+METRICS_FILE = None
+METRICS_DUMP_INTERVAL = 30
+
+
+def apply_metrics_settings(settings: dict):
+    global METRICS_FILE, METRICS_DUMP_INTERVAL
+
+    if settings.get("metrics_file"):
+        METRICS_FILE = Path(settings["metrics_file"])
+    if settings.get("metrics_dump_interval"):
+        METRICS_DUMP_INTERVAL = float(settings["metrics_dump_interval"])
+
 
 async def connect_openai_servers():
-    from configparser import ConfigParser
     from core import JPTranslator, OpenAiServer
+    from core.TextGeneration.TranslationMemory import TranslationMemory, TRANSLATION_MEMORY_PATH
 
-    server_list_config = ConfigParser()
-    server_list_config.read("server-list.ini", encoding="utf-8")
+    server_configs, settings = read_server_list()
+    apply_metrics_settings(settings)
 
     tg = JPTranslator()
-    for config in server_list_config._sections.values():
+    tg.translation_memory = TranslationMemory(TRANSLATION_MEMORY_PATH)
+    for config in server_configs:
         if config.get("enable", "").lower() in ["false", "no", "n", "0"]:
             continue
 
@@ -42,6 +58,11 @@ async def connect_openai_servers():
 
     tg.start_server()
 
+    if METRICS_FILE is not None:
+        from utils.metrics import REGISTRY
+
+        REGISTRY.start_file_dump(METRICS_FILE, METRICS_DUMP_INTERVAL)
+
     if len(tg.servers) == 0:
         logger.error("没有可用的API服务器")
         logger.error("请检查配置文件 server-list.ini 是否正确配置")
@@ -53,18 +74,32 @@ async def connect_openai_servers():
     return tg
 
 
+def save_metrics():
+    if METRICS_FILE is None:
+        return
+    from utils.metrics import REGISTRY
+
+    REGISTRY.write_to_file(METRICS_FILE)
+    logger.info(f"监控指标已保存到 {METRICS_FILE}")
+
+
 @ag.apply("请拖入游戏目录")
-def unity_game(game_path: Path):
+def unity_game(game_path: Path, workers: int = 1):
     from core.UnityExtractor.TextFinder import TextFinder
 
     global last_game_path
 
     utf = TextFinder(game_path)
-    utf.dump_prepare_text()
+    utf.dump_prepare_text(workers)
 
     last_game_path = utf.game_path
 
 
+@ag.apply("请拖入游戏目录")
+def unity_game_multiprocess(game_path: Path):
+    unity_game(game_path, workers=os.cpu_count())
+
+
 async def run_translate_async(game_path: Path):
     tg = await connect_openai_servers()
 
@@ -72,6 +107,7 @@ async def run_translate_async(game_path: Path):
     text_list = tg.read_prepare_text()
 
     await tg.translate(text_list)
+    save_metrics()
 
     # await tg.unload_model()
     logger.info("翻译完成")
@@ -132,8 +168,11 @@ async def run_translate_json_async(json_path: Path):
             cache_data = {}
 
         pending_data = {}
-        for key, value in tqdm(data.items(), desc="生成待翻译文件"):
-            if has_japanese(key):
+        japanese_mask = has_japanese_batch(list(data))
+        for (key, value), is_japanese in zip(
+            tqdm(data.items(), desc="生成待翻译文件"), japanese_mask
+        ):
+            if is_japanese:
                 pending_data[key] = cache_data.get(key, "")
             else:
                 pending_data[key] = value
@@ -148,6 +187,7 @@ async def run_translate_json_async(json_path: Path):
     await tg.translate(
         text_list, target_out_file=pending_file, tran_cache_file=tran_cache
     )
+    save_metrics()
     logger.info("翻译完成")
 
 
@@ -156,6 +196,24 @@ def run_translate_json(json_path: Path):
     asyncio.run(run_translate_json_async(json_path))
 
 
+@ag.apply("请拖入需要导入翻译记忆的Json文件 (例如 xxx_Translated.json)")
+def run_import_translation_memory(json_path: Path):
+    from core.TextGeneration.TranslationMemory import TranslationMemory, TRANSLATION_MEMORY_PATH
+
+    memory = TranslationMemory(TRANSLATION_MEMORY_PATH)
+    memory.import_json(json_path)
+    memory.close()
+
+
+@ag.apply("请输入导出翻译记忆的Json文件路径")
+def run_export_translation_memory(json_path: Path):
+    from core.TextGeneration.TranslationMemory import TranslationMemory, TRANSLATION_MEMORY_PATH
+
+    memory = TranslationMemory(TRANSLATION_MEMORY_PATH)
+    memory.export_json(json_path)
+    memory.close()
+
+
 @ag.apply("请拖入游戏目录")
 def test(game_path: Path):
     import dumb_menu
@@ -176,8 +234,16 @@ async def run_api_server():
     from server import run_server
     from threading import Thread
 
+    # 合并并发请求的时间窗口和每批最多的文本数, 在 server-list.ini 的 [settings] 中设置
+    _, settings = read_server_list()
+    kwargs = {}
+    if settings.get("api_batch_window"):
+        kwargs["batch_window"] = float(settings["api_batch_window"])
+    if settings.get("api_batch_max_size"):
+        kwargs["batch_max_size"] = int(settings["api_batch_max_size"])
+
     t = Thread(
-        target=run_server, daemon=True
+        target=run_server, kwargs=kwargs, daemon=True
     )
     t.start()
     t.join()
@@ -193,10 +259,13 @@ def run():
         options={
             # test: "测试",
             unity_game: "1. 提取游戏文本资源 (先选这个, 生成需要翻译的文本)",
+            unity_game_multiprocess: "额外功能: 多进程提取游戏文本资源 (适用于大型游戏)",
             run_translate: "2. 使用AI翻提取前的文本",
             run_write_unity_file: "3. 替换游戏内文本 (翻译完成后, 选这个)",
             run_replace_font: "4. 替换游戏内字体 (出现口口或者识别不出中文的情况, 选这个)",
             run_translate_json: "额外功能: 翻译其他工具导出的Json文件",
+            run_import_translation_memory: "额外功能: 导入翻译缓存到翻译记忆",
+            run_export_translation_memory: "额外功能: 导出翻译记忆",
             run_api_server_async: "启动API服务器",
         },
         args={
@@ -210,4 +279,6 @@ def run():
 
 
 if __name__ == "__main__":
+    # 打包后多进程提取需要
+    multiprocessing.freeze_support()
     run()
@@ -1,25 +1,28 @@
+import asyncio
 import uvicorn
+import ujson as json
 from fastapi import Depends, FastAPI, Header, HTTPException
 from fastapi.logger import logger as fastapi_logger
 from fastapi.middleware.cors import CORSMiddleware
 from fastapi.requests import Request
-from fastapi.responses import JSONResponse
+from fastapi.responses import JSONResponse, PlainTextResponse, StreamingResponse
 
-from configparser import ConfigParser
 from core import JPTranslator, OpenAiServer
+from core.TextGeneration.TranslationMemory import TranslationMemory, TRANSLATION_MEMORY_PATH
 
-from utils import logger
+from utils import logger, read_server_list
+from utils.metrics import REGISTRY
 
 app = FastAPI()
 
 
 
 async def connect_openai_servers():
-    server_list_config = ConfigParser()
-    server_list_config.read("server-list.ini", encoding="utf-8")
+    server_configs, _ = read_server_list()
 
     tg = JPTranslator()
-    for config in server_list_config._sections.values():
+    tg.translation_memory = TranslationMemory(TRANSLATION_MEMORY_PATH)
+    for config in server_configs:
         if config.get("enable", "").lower() in ["false", "no", "n", "0"]:
             continue
 
@@ -56,13 +59,103 @@ app.add_middleware(
 async def options_route():
     return JSONResponse(content="OK")
 
+
+@app.get("/metrics")
+async def metrics():
+    return PlainTextResponse(
+        REGISTRY.render(), media_type="text/plain; version=0.0.4"
+    )
+
 TG: JPTranslator = None
+# 第一批并发请求只连接一次服务器
+TG_CONNECT_LOCK = asyncio.Lock()
+# 每个请求只读取自己的结果, result_data 只作为共享缓存, 超出后丢弃最早的结果
+RESULT_DATA_MAX_SIZE = 100000
 
 async def connect_instance():
     global TG
-    if TG is None:
-        TG = await connect_openai_servers()
-    TG.result_data = {}
+    async with TG_CONNECT_LOCK:
+        if TG is None:
+            TG = await connect_openai_servers()
+
+class MicroBatcher:
+    """把时间窗口内参数相同的并发请求合并成一次 translate 调用, 每个请求只拿回自己的结果
+
+    hook 每次只发送一句文本时, 短时间内的多个请求会一起入队, 服务器可以成批处理
+    """
+
+    def __init__(self, window: float = 0.01, max_batch_size: int = 64):
+        # 等待合并的时间窗口 (秒), 为 0 时不合并
+        self.window = window
+        # 一批最多多少行, 达到后立即发送
+        self.max_batch_size = max_batch_size
+        self.batches: dict[str, list[tuple[list[str], asyncio.Future]]] = {}
+        self.batch_args: dict[str, tuple] = {}
+        self.flush_handles: dict[str, asyncio.TimerHandle] = {}
+        self.running_tasks: set[asyncio.Task] = set()
+
+    async def translate(
+        self,
+        text_list: list[str],
+        is_strictest: bool = False,
+        glossary_path: str = None,
+        glossary: dict[str, str] = None,
+    ) -> dict[str, str]:
+        if self.window <= 0:
+            result = await TG.translate(
+                text_list, None, None, is_strictest, glossary_path, glossary, True
+            )
+            TG.trim_result_data(RESULT_DATA_MAX_SIZE)
+            return result
+
+        loop = asyncio.get_running_loop()
+        key = json.dumps([is_strictest, glossary_path, glossary], sort_keys=True)
+        batch = self.batches.setdefault(key, [])
+        if not batch:
+            self.batch_args[key] = (is_strictest, glossary_path, glossary)
+            self.flush_handles[key] = loop.call_later(self.window, self.flush, key)
+
+        future = loop.create_future()
+        batch.append((text_list, future))
+        if sum(len(lines) for lines, _ in batch) >= self.max_batch_size:
+            self.flush(key)
+
+        return await future
+
+    def flush(self, key: str):
+        batch = self.batches.pop(key, None)
+        if not batch:
+            return
+        self.flush_handles.pop(key).cancel()
+        task = asyncio.create_task(self.run_batch(batch, self.batch_args.pop(key)))
+        self.running_tasks.add(task)
+        task.add_done_callback(self.running_tasks.discard)
+
+    async def run_batch(
+        self, batch: list[tuple[list[str], asyncio.Future]], args: tuple
+    ):
+        text_list = list(dict.fromkeys(line for lines, _ in batch for line in lines))
+        is_strictest, glossary_path, glossary = args
+        try:
+            result = await TG.translate(
+                text_list, None, None, is_strictest, glossary_path, glossary, True
+            )
+        except Exception as e:
+            for _, future in batch:
+                if not future.done():
+                    future.set_exception(e)
+            return
+        finally:
+            TG.trim_result_data(RESULT_DATA_MAX_SIZE)
+
+        for lines, future in batch:
+            # 客户端断开时 future 已被取消
+            if not future.done():
+                future.set_result({line: result[line] for line in lines})
+
+
+BATCHER = MicroBatcher()
+
 
 @app.post("/translateJP")
 async def translateJP(request: Request):
@@ -79,21 +172,67 @@ async def translateJP(request: Request):
     no_save_file = True
     
     await connect_instance()
-    
-    return JSONResponse(
-        await TG.translate(
-            text_list,
-            target_out_file,
-            tran_cache_file,
-            is_strictest,
-            glossary_path,
-            glossary,
-            no_save_file,
+
+    # 指定了缓存文件的请求单独翻译, 其他请求合并后一起翻译
+    if tran_cache_file is None:
+        return JSONResponse(
+            await BATCHER.translate(text_list, is_strictest, glossary_path, glossary)
         )
+
+    # translate 只在事件循环上等待结果, 不会阻塞其他请求
+    result = await TG.translate(
+        text_list,
+        target_out_file,
+        tran_cache_file,
+        is_strictest,
+        glossary_path,
+        glossary,
+        no_save_file,
     )
+    TG.trim_result_data(RESULT_DATA_MAX_SIZE)
+    return JSONResponse(result)
+
+
+@app.post("/translateJP/stream")
+async def translateJP_stream(request: Request):
+    """逐行返回翻译结果, 每行完成后立即发送 {"source", "translation"}
+
+    默认返回 NDJSON, 请求头 Accept 为 text/event-stream 时返回 SSE
+    """
+    body = await request.json()
+    text_list = body.get("text_list")
+    if not text_list:
+        raise HTTPException(status_code=400, detail="Missing text parameter")
+
+    is_strictest = body.get("is_strictest", False)
+    glossary_path = body.get("glossary_path")
+    glossary = body.get("glossary")
+    is_sse = "text/event-stream" in request.headers.get("accept", "")
+
+    await connect_instance()
+
+    async def stream():
+        try:
+            async for source, translation in TG.translate_iter(
+                text_list, is_strictest, glossary_path, glossary
+            ):
+                data = json.dumps(
+                    {"source": source, "translation": translation}, ensure_ascii=False
+                )
+                yield f"data: {data}\n\n" if is_sse else f"{data}\n"
+        finally:
+            TG.trim_result_data(RESULT_DATA_MAX_SIZE)
+
+    return StreamingResponse(
+        stream(),
+        media_type="text/event-stream" if is_sse else "application/x-ndjson",
+    )
+
 
+def run_server(is_public=False, port=7680, batch_window=0.01, batch_max_size=64):
+    BATCHER.window = batch_window
+    BATCHER.max_batch_size = batch_max_size
 
-def run_server(is_public=False, port=7680):
     server_addr = "0.0.0.0" if is_public else "127.0.0.1"
     logger.info(f"Starting server on http://{server_addr}:{port}")
     uvicorn.run(app, host=server_addr, port=port, access_log=False)
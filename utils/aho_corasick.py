@@ -0,0 +1,73 @@
+from collections import deque
+from typing import Iterable
+
+
+class AhoCorasick:
+    """多模式字符串匹配, 一次扫描找出文本中出现的所有关键词
+
+    例子:
+    matcher = AhoCorasick(["アリス", "ボブ"])
+    matcher.find_all("アリスとボブ")  # ["アリス", "ボブ"]
+
+    返回的关键词按添加顺序排列且不重复, 与逐个 `key in text` 判断的结果一致
+    """
+
+    __slots__ = ("words", "goto", "fail", "output")
+
+    def __init__(self, words: Iterable[str] = ()):
+        self.words: list[str] = []
+        self.goto: list[dict[str, int]] = [{}]
+        self.fail: list[int] = [0]
+        self.output: list[tuple[int, ...]] = [()]
+        for word in words:
+            self.add(word)
+        self.build()
+
+    def add(self, word: str):
+        if not word:
+            return
+        node = 0
+        for char in word:
+            next_node = self.goto[node].get(char)
+            if next_node is None:
+                next_node = len(self.goto)
+                self.goto[node][char] = next_node
+                self.goto.append({})
+                self.fail.append(0)
+                self.output.append(())
+            node = next_node
+        if not self.output[node]:
+            self.output[node] = (len(self.words),)
+            self.words.append(word)
+
+    def build(self):
+        queue = deque(self.goto[0].values())
+        for node in queue:
+            self.fail[node] = 0
+        while queue:
+            node = queue.popleft()
+            for char, next_node in self.goto[node].items():
+                queue.append(next_node)
+                fail = self.fail[node]
+                while fail and char not in self.goto[fail]:
+                    fail = self.fail[fail]
+                fail = self.goto[fail].get(char, 0)
+                self.fail[next_node] = fail
+                if self.output[fail]:
+                    # 合并后缀节点上的关键词
+                    self.output[next_node] = self.output[next_node] + self.output[fail]
+
+    def find_all(self, text: str) -> list[str]:
+        goto, fail, output = self.goto, self.fail, self.output
+        found = set()
+        node = 0
+        for char in text:
+            while node and char not in goto[node]:
+                node = fail[node]
+            node = goto[node].get(char, 0)
+            if output[node]:
+                found.update(output[node])
+        return [self.words[index] for index in sorted(found)]
+
+    def __len__(self):
+        return len(self.words)
@@ -0,0 +1,233 @@
+"""简单的 Prometheus 文本格式监控指标
+
+REQUESTS = Counter("requests_total", "请求数", ["server"])
+REQUESTS.labels(server="local").inc()
+REGISTRY.render()  # Prometheus 文本格式
+"""
+import os
+import math
+import time
+
+from pathlib import Path
+from threading import Lock, Thread
+from typing import Callable, Iterable
+
+
+def _format_value(value: float) -> str:
+    if value == math.inf:
+        return "+Inf"
+    if float(value).is_integer():
+        return str(int(value))
+    return repr(float(value))
+
+
+def _escape(value: str) -> str:
+    return value.replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+
+def _format_labels(names: Iterable[str], values: Iterable[str]) -> str:
+    labels = ",".join(f'{name}="{_escape(value)}"' for name, value in zip(names, values))
+    return f"{{{labels}}}" if labels else ""
+
+
+class Registry:
+    def __init__(self):
+        self.metrics: list[Metric] = []
+        self.lock = Lock()
+        self.dump_files: set[Path] = set()
+
+    def register(self, metric: "Metric"):
+        with self.lock:
+            self.metrics.append(metric)
+
+    def render(self) -> str:
+        with self.lock:
+            metrics = list(self.metrics)
+        lines = []
+        for metric in metrics:
+            lines.append(f"# HELP {metric.name} {metric.documentation}")
+            lines.append(f"# TYPE {metric.name} {metric.type}")
+            lines.extend(metric.collect())
+        return "\n".join(lines) + "\n"
+
+    def write_to_file(self, file_path: Path):
+        file_path = Path(file_path)
+        temp_file = file_path.with_name(file_path.name + ".tmp")
+        temp_file.write_text(self.render(), encoding="utf-8")
+        os.replace(temp_file, file_path)
+
+    def start_file_dump(self, file_path: Path, interval: float = 30):
+        """后台定时把指标写入文件, 命令行模式下没有 /metrics 接口时使用"""
+        file_path = Path(file_path)
+        with self.lock:
+            if file_path in self.dump_files:
+                return
+            self.dump_files.add(file_path)
+
+        def dump():
+            while True:
+                time.sleep(interval)
+                self.write_to_file(file_path)
+
+        Thread(target=dump, daemon=True).start()
+
+
+REGISTRY = Registry()
+
+
+class Metric:
+    type = ""
+
+    def __init__(
+        self,
+        name: str,
+        documentation: str,
+        labelnames: Iterable[str] = (),
+        registry: Registry = REGISTRY,
+    ):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self.lock = Lock()
+        self.children: dict[tuple[str, ...], object] = {}
+        registry.register(self)
+
+    def labels(self, *values, **kwargs):
+        if kwargs:
+            values = tuple(kwargs[name] for name in self.labelnames)
+        key = tuple(str(value) for value in values)
+        if len(key) != len(self.labelnames):
+            raise ValueError(f"{self.name} 需要标签 {self.labelnames}")
+        with self.lock:
+            child = self.children.get(key)
+            if child is None:
+                child = self.children[key] = self.new_child()
+        return child
+
+    def new_child(self):
+        raise NotImplementedError
+
+    def items(self) -> list[tuple[tuple[str, ...], object]]:
+        with self.lock:
+            return list(self.children.items())
+
+    def collect(self) -> list[str]:
+        return [
+            f"{self.name}{_format_labels(self.labelnames, key)} {_format_value(child.get())}"
+            for key, child in self.items()
+        ]
+
+
+class _Value:
+    __slots__ = ("value", "lock", "function")
+
+    def __init__(self):
+        self.value = 0.0
+        self.lock = Lock()
+        self.function: Callable[[], float] = None
+
+    def inc(self, amount: float = 1):
+        with self.lock:
+            self.value += amount
+
+    def dec(self, amount: float = 1):
+        self.inc(-amount)
+
+    def set(self, value: float):
+        with self.lock:
+            self.value = value
+
+    def set_function(self, function: Callable[[], float]):
+        """读取指标时调用 function 获取当前值"""
+        self.function = function
+
+    def get(self) -> float:
+        if self.function is not None:
+            return self.function()
+        return self.value
+
+
+class Counter(Metric):
+    type = "counter"
+
+    def new_child(self):
+        return _Value()
+
+    def inc(self, amount: float = 1):
+        self.labels().inc(amount)
+
+
+class Gauge(Metric):
+    type = "gauge"
+
+    def new_child(self):
+        return _Value()
+
+    def set(self, value: float):
+        self.labels().set(value)
+
+    def set_function(self, function: Callable[[], float]):
+        self.labels().set_function(function)
+
+
+class _Histogram:
+    __slots__ = ("buckets", "counts", "sum", "lock")
+
+    def __init__(self, buckets: tuple[float, ...]):
+        self.buckets = buckets
+        self.counts = [0] * len(buckets)
+        self.sum = 0.0
+        self.lock = Lock()
+
+    def observe(self, value: float):
+        with self.lock:
+            self.sum += value
+            for index, bound in enumerate(self.buckets):
+                if value <= bound:
+                    self.counts[index] += 1
+                    break
+
+    def snapshot(self) -> tuple[list[int], float]:
+        with self.lock:
+            return list(self.counts), self.sum
+
+
+class Histogram(Metric):
+    type = "histogram"
+    DEFAULT_BUCKETS = (0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, math.inf)
+
+    def __init__(
+        self,
+        name: str,
+        documentation: str,
+        labelnames: Iterable[str] = (),
+        buckets: Iterable[float] = DEFAULT_BUCKETS,
+        registry: Registry = REGISTRY,
+    ):
+        buckets = tuple(sorted(buckets))
+        if buckets[-1] != math.inf:
+            buckets += (math.inf,)
+        self.buckets = buckets
+        super().__init__(name, documentation, labelnames, registry)
+
+    def new_child(self):
+        return _Histogram(self.buckets)
+
+    def observe(self, value: float):
+        self.labels().observe(value)
+
+    def collect(self) -> list[str]:
+        lines = []
+        for key, child in self.items():
+            counts, total = child.snapshot()
+            cumulative = 0
+            for bound, count in zip(self.buckets, counts):
+                cumulative += count
+                labels = _format_labels(
+                    self.labelnames + ("le",), key + (_format_value(bound),)
+                )
+                lines.append(f"{self.name}_bucket{labels} {cumulative}")
+            labels = _format_labels(self.labelnames, key)
+            lines.append(f"{self.name}_sum{labels} {_format_value(total)}")
+            lines.append(f"{self.name}_count{labels} {cumulative}")
+        return lines
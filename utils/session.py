@@ -3,13 +3,15 @@ import functools
 import ujson
 import asyncio
 
+from datetime import datetime, timezone
+from email.utils import parsedate_to_datetime
+
 import aiohttp
 from aiohttp import client_exceptions
 from tenacity import retry, stop_after_attempt, wait_fixed
 
 from enum import Enum
-from types import TracebackType
-from typing import Any, Optional, Type, TypeVar
+from typing import Any, Optional, TypeVar
 
 from .tools import Error_Message
 from .log import logger, retry_log
@@ -23,30 +25,83 @@ class HTTPMethod(Enum):
     POST = "POST"
 
 
+class HTTPStatusError(Error_Message):
+    """服务器返回了非 200 的状态码"""
+
+    def __init__(self, message="", status: int = 0, retry_after: float = None):
+        super().__init__(message)
+        self.status = status
+        # 429/503 响应中 Retry-After 指定的等待秒数
+        self.retry_after = retry_after
+
+    @property
+    def transient(self) -> bool:
+        """限流, 超时和服务器错误可以稍后重试"""
+        return self.status in (408, 429) or self.status >= 500
+
+
+class HTTPTimeoutError(Error_Message):
+    pass
+
+
+def parse_retry_after(value: str | None) -> float | None:
+    """Retry-After 可以是秒数或者 HTTP 日期"""
+    if not value:
+        return None
+    try:
+        return max(0.0, float(value))
+    except ValueError:
+        pass
+    try:
+        retry_time = parsedate_to_datetime(value)
+    except (TypeError, ValueError):
+        return None
+    return max(0.0, (retry_time - datetime.now(timezone.utc)).total_seconds())
+
+
 class HTTPSession:
-    def __init__(self, headers=None):
+    """每个事件循环持有一个长连接的 ClientSession, 复用 TCP/TLS 连接"""
+
+    def __init__(
+        self,
+        headers=None,
+        limit: int = 100,
+        keepalive_timeout: float = 30,
+        ttl_dns_cache: int = 300,
+    ):
         self.headers = headers
+        self.limit = limit
+        self.keepalive_timeout = keepalive_timeout
+        self.ttl_dns_cache = ttl_dns_cache
+        # aiohttp 的 session 不能跨事件循环使用
+        self.sessions: dict[asyncio.AbstractEventLoop, aiohttp.ClientSession] = {}
 
     async def _create(self) -> aiohttp.ClientSession:
         return aiohttp.ClientSession(
             headers=self.headers,
-            connector=aiohttp.TCPConnector(ssl=False),
+            connector=aiohttp.TCPConnector(
+                ssl=False,
+                limit=self.limit,
+                keepalive_timeout=self.keepalive_timeout,
+                use_dns_cache=True,
+                ttl_dns_cache=self.ttl_dns_cache,
+            ),
             json_serialize=ujson.dumps,
             timeout=aiohttp.ClientTimeout(total=5 * 60 * 60),
         )
 
-    async def __aenter__(self) -> aiohttp.ClientSession:
-        session_object = await self._create()
-        self.session = await session_object.__aenter__()
-        return self.session
+    async def get(self) -> aiohttp.ClientSession:
+        loop = asyncio.get_running_loop()
+        session = self.sessions.get(loop)
+        if session is None or session.closed:
+            session = await self._create()
+            self.sessions[loop] = session
+        return session
 
-    async def __aexit__(
-        self,
-        exc_type: Optional[Type[BaseException]],
-        exc_val: Optional[BaseException],
-        exc_tb: Optional[TracebackType],
-    ) -> None:
-        await self.session.close()
+    async def close(self) -> None:
+        session = self.sessions.pop(asyncio.get_running_loop(), None)
+        if session is not None and not session.closed:
+            await session.close()
 
     def Session(f):
         @functools.wraps(f)
@@ -57,8 +112,7 @@ class HTTPSession:
             **kwargs: Any,
         ) -> T:
             if session is None:
-                async with self._session as session:
-                    return await f(self, *args, session=session, **kwargs)
+                session = await self._session.get()
             return await f(self, *args, session=session, **kwargs)
 
         return wrapper
@@ -69,13 +123,27 @@ class HTTPSessionApi:
     proxy: str = ""
     _session: aiohttp.ClientSession
 
-    def __init__(self, host, proxy=None):
+    def __init__(
+        self,
+        host,
+        proxy=None,
+        limit: int = 100,
+        keepalive_timeout: float = 30,
+        ttl_dns_cache: int = 300,
+    ):
         self.host = host
         self.proxy = proxy
-        self._session = HTTPSession()
-        
+        self._session = HTTPSession(
+            limit=limit,
+            keepalive_timeout=keepalive_timeout,
+            ttl_dns_cache=ttl_dns_cache,
+        )
+
+    async def open_session(self) -> aiohttp.ClientSession:
+        return await self._session.get()
+
     async def close_session(self):
-        await self._session.session.close()
+        await self._session.close()
 
     # @retry(stop=stop_after_attempt(20), wait=wait_fixed(3), before=retry_log, reraise=True)
     @HTTPSession.Session
@@ -103,7 +171,11 @@ class HTTPSessionApi:
                 if resp.status == 200:
                     return await resp.json()
                 else:
-                    raise Error_Message(f"请求错误: {resp.status}")
+                    raise HTTPStatusError(
+                        f"请求错误: {resp.status}",
+                        resp.status,
+                        parse_retry_after(resp.headers.get("Retry-After")),
+                    )
 
         except client_exceptions.InvalidURL:
             err_msg = f"错误的服务器地址 ({self.host})"
@@ -120,6 +192,6 @@ class HTTPSessionApi:
         except asyncio.TimeoutError:
             err_msg = f"连接服务器超时 ({self.host})"
             if raise_error:
-                raise Error_Message(err_msg)
+                raise HTTPTimeoutError(err_msg)
             else:
                 logger.warning(err_msg)
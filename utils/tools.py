@@ -5,13 +5,22 @@ import hashlib
 import inspect
 import unicodedata
 
+from functools import lru_cache
 from threading import Thread
 from pathlib import Path
 from ruamel.yaml import YAML
 from tqdm import tqdm
 
+from configparser import ConfigParser
+
 from .simple_config import SimpleConfig
 
+try:
+    import xxhash
+except ImportError:
+    # 可选依赖, 没有安装时使用 blake2b
+    xxhash = None
+
 
 def find_unity_game_data_path(game_path: Path):
     if game_path.suffix == ".exe":
@@ -25,28 +34,117 @@ def find_unity_game_data_path(game_path: Path):
     )[0]
     return game_exe.with_name(game_exe.stem + "_Data")
 
+# 与原来逐个 replace 的结果一致: '―' 先被替换成 '-', 之后替换成 'ー' 的规则不会生效
+_JAPANESE_NORMALIZE_TABLE = str.maketrans(
+    {
+        **dict.fromkeys("〜～﹣－—━─", "ー"),
+        **dict.fromkeys("―‐˗֊‑‒–⁃⁻₋−", "-"),
+        "’": "'",
+        "”": '"',
+        "“": '"',
+    }
+)
+# ASCII, 常用日文标点, 假名和汉字: NFKC 后不变, 不是组合字符, 也不会和前面的字符组合,
+# 在它们前面断开分别做 NFKC 与整体做 NFKC 的结果相同. 上面替换表中的字符都不在其中
+_NFKC_STABLE_CHARS = "\x00-\x7f、-〃々-〇「-】ぁ-ゖァ-ヾ㐀-䶿一-鿿"
+# 其余字符组成的片段连同前一个字符, 只有这些片段需要替换和 NFKC
+_nfkc_unstable_pattern = re.compile(f".?[^{_NFKC_STABLE_CHARS}]+", re.DOTALL)
+
+
+def _normalize_segment(match):
+    return unicodedata.normalize("NFKC", match.group().translate(_JAPANESE_NORMALIZE_TABLE))
+
+
 def japanese_normalize(text):
-    text = text.replace('〜', 'ー').replace('～', 'ー')
-    text = text.replace("’", "'").replace('”', '"').replace('“', '"')
-    text = text.replace('―', '-').replace('‐','-').replace('˗','-').replace('֊', '-')
-    text = text.replace('‐', '-').replace('‑','-').replace('‒','-').replace('–', '-')
-    text = text.replace('⁃', '-').replace('⁻','-').replace('₋', '-').replace('−', '-')
-    text = text.replace('﹣', 'ー').replace('－','ー').replace('—','ー').replace('―', 'ー')
-    text = text.replace('━', 'ー').replace('─', 'ー')
-    return unicodedata.normalize("NFKC", text)
+    # 日文文本大部分是假名和汉字, 整行 NFKC 的开销主要花在它们身上, 只处理其余的片段
+    return _nfkc_unstable_pattern.sub(_normalize_segment, text)
+
+
+# 游戏文本中重复的台词很多, 重试和备份请求也会对同一文本再次调用
+japanese_normalize_cached = lru_cache(maxsize=1 << 16)(japanese_normalize)
+
+
+# 平假名, 片假名, CJK 扩展 A 和基本汉字
+JAPANESE_CHARS = "\u3040-\u30ff\u3400-\u4DBF\u4E00-\u9FFF"
+_japanese_pattern = re.compile(f"[{JAPANESE_CHARS}]")
+_japanese_text_pattern = re.compile(f"[{JAPANESE_CHARS}]+")
+
+# NFKC 会改变并且与日文字符有关的字符只出现在这些区块中: 康熙部首, 假名和 CJK 符号,
+# 带圈字符, 兼容汉字, 半角假名和全角字符, 带框汉字
+_NFKC_BLOCKS = [
+    (0x2E80, 0x3400),
+    (0xF900, 0xFB00),
+    (0xFE00, 0xFFF0),
+    (0x1F200, 0x1F300),
+    (0x2F800, 0x2FA20),
+]
+
+
+def _make_nfkc_sensitive_pattern():
+    """匹配 NFKC 前后会影响日文判断和提取结果的字符, 文本中没有这些字符时可以跳过 NFKC"""
+    codes = [0x3099, 0x309A]  # 组合用浊点和半浊点, NFKC 会与前面的假名合并
+    for start, end in _NFKC_BLOCKS:
+        for code in range(start, end):
+            char = chr(code)
+            normalized = unicodedata.normalize("NFKC", char)
+            if normalized != char and (
+                _japanese_pattern.search(char) or _japanese_pattern.search(normalized)
+            ):
+                codes.append(code)
+
+    # 合并成连续区间, 逐个列出上千个字符会让正则退化成逐个比较;
+    # BMP 以外的字符很少见, 直接用整个区块, 多做一次 NFKC 不影响结果
+    ranges = [[start, end - 1] for start, end in _NFKC_BLOCKS if start > 0xFFFF]
+    for code in sorted(code for code in codes if code <= 0xFFFF):
+        if ranges and ranges[-1][1] + 1 == code:
+            ranges[-1][1] = code
+        else:
+            ranges.append([code, code])
+    return re.compile(
+        "[" + "".join(f"{re.escape(chr(start))}-{re.escape(chr(end))}" for start, end in ranges) + "]"
+    )
+
+
+_nfkc_sensitive_pattern = _make_nfkc_sensitive_pattern()
+
 
 def has_japanese(text):
+    # 日文字符 NFKC 后仍然是日文字符, 直接匹配到就不需要 NFKC
+    if _japanese_pattern.search(text):
+        return True
+    if text.isascii() or not _nfkc_sensitive_pattern.search(text):
+        return False
     text = unicodedata.normalize("NFKC", text)
-    return bool(re.search(r"[\u3040-\u30ff\u3400-\u4DBF\u4E00-\u9FFF]", text))
+    return _japanese_pattern.search(text) is not None
 
-def get_japanese_text(text):
-    text = unicodedata.normalize("NFKC", text)
-    return re.findall(r"[\u3040-\u30ff\u3400-\u4DBF\u4E00-\u9FFF]+", text)
 
-    # japanese_pattern = re.compile(
-    #     r"[\u3040-\u309F\u30A0-\u30FA\u30FD-\u30FF\uFF66-\uFF9F]+"
-    # )
-    # return bool(japanese_pattern.search(text))
+def get_japanese_text(text):
+    if not text.isascii() and _nfkc_sensitive_pattern.search(text):
+        text = unicodedata.normalize("NFKC", text)
+    return _japanese_text_pattern.findall(text)
+
+
+def has_japanese_batch(texts: list[str]) -> list[bool]:
+    """批量判断, 返回与 texts 一一对应的 bool 列表, 非字符串视为 False
+
+    用于筛选大量导出的字段, 省去逐个调用 has_japanese 的开销,
+    只有不含日文字符但含兼容字符的文本才会做 NFKC
+    """
+    search = _japanese_pattern.search
+    sensitive = _nfkc_sensitive_pattern.search
+    normalize = unicodedata.normalize
+    return [
+        isinstance(text, str)
+        and (
+            search(text) is not None
+            or (
+                not text.isascii()
+                and sensitive(text) is not None
+                and search(normalize("NFKC", text)) is not None
+            )
+        )
+        for text in texts
+    ]
 
 
 def is_repetitive(text):
@@ -72,6 +170,20 @@ class Error_Message(Exception):
         return self.message
 
 
+# server-list.ini 中这一节是全局设置, 不是服务器
+SERVER_LIST_SETTINGS = "settings"
+
+
+def read_server_list(file_path: Path = Path("server-list.ini")) -> tuple[list[dict], dict]:
+    """返回服务器配置列表和 [settings] 中的全局设置"""
+    server_list_config = ConfigParser()
+    server_list_config.read(file_path, encoding="utf-8")
+
+    sections = dict(server_list_config._sections)
+    settings = sections.pop(SERVER_LIST_SETTINGS, {})
+    return list(sections.values()), settings
+
+
 def get_ecx_path(*paths):
     base_path = Path(sys.argv[0]).resolve().parent
     if (base_path / "_internal").exists():
@@ -87,6 +199,69 @@ def str2md5(s):
     return md5(str(s).encode())
 
 
+def blake2b64(s: str) -> int:
+    return int.from_bytes(
+        hashlib.blake2b(s.encode("utf-8", "surrogatepass"), digest_size=8).digest(), "little"
+    )
+
+
+def xxhash64(s: str) -> int:
+    return xxhash.xxh3_64_intdigest(s.encode("utf-8", "surrogatepass"))
+
+
+# 内存中作为字典键使用的 64 位 hash, 安装了 xxhash 时优先使用
+HASH_FUNCTIONS = {"blake2b": blake2b64}
+if xxhash is not None:
+    HASH_FUNCTIONS["xxhash"] = xxhash64
+_hash_function = HASH_FUNCTIONS["xxhash" if xxhash is not None else "blake2b"]
+
+
+def set_hash_function(name: str):
+    """切换 fast_hash / hash_text 使用的 hash 函数, 需要在产生任何 hash 之前调用"""
+    global _hash_function
+    _hash_function = HASH_FUNCTIONS[name]
+    hash_text.cache_clear()
+
+
+def fast_hash(s: str) -> int:
+    """非加密的 64 位 hash, 只在当前进程内使用, 不同环境下结果可能不同, 不要写入文件"""
+    return _hash_function(s)
+
+
+@lru_cache(maxsize=1 << 16)
+def hash_text(s: str) -> int:
+    """带缓存的 fast_hash, 同一行文本在提交, 处理和组合结果时会多次计算"""
+    return _hash_function(s)
+
+
+def text_data_hash(s: str) -> str:
+    """text_data.json 中保存的 text_hash 和 value_hash, 固定使用 blake2b 保证不同环境下一致"""
+    return hashlib.blake2b(str(s).encode("utf-8", "surrogatepass"), digest_size=8).hexdigest()
+
+
+def migrate_text_data(text_data: list[dict]) -> int:
+    """把旧版本 text_data.json 中的 md5 (32 位十六进制) 换成 text_data_hash, 返回更新的条数"""
+    count = 0
+    for item in text_data:
+        migrated = False
+        if len(item["text_hash"]) == 32:
+            item["text_hash"] = text_data_hash(item["text"])
+            migrated = True
+        if len(item.get("value_hash", "")) == 32:
+            item["value_hash"] = text_data_hash(item["value"])
+            migrated = True
+        count += migrated
+    return count
+
+
+def file_md5(file_path, chunk_size=1 << 20):
+    h = hashlib.md5()
+    with open(file_path, "rb") as f:
+        for chunk in iter(lambda: f.read(chunk_size), b""):
+            h.update(chunk)
+    return h.hexdigest()
+
+
 class Config(SimpleConfig): ...
 
 
@@ -98,7 +273,7 @@ def get_func_key(func, *fn_args, **fn_kwargs):
     bound = inspect.signature(func).bind(*fn_args, **fn_kwargs)
     bound.apply_defaults()
     bound.arguments.pop("self", None)
-    return str2md5(f"{func.__name__}@{bound.arguments}")
+    return f"{fast_hash(f'{func.__name__}@{bound.arguments}'):016x}"
 
 
 def create_thread(func: callable, task_id: str = None, *args, **kwargs):
@@ -127,6 +302,92 @@ def file_size_str(path):
     return size_format(os.stat(path).st_size)
 
 
+def render_object_path(parent_path: str, path) -> str:
+    """把 (key, index, ...) 形式的路径拼成 parent_path.key[index] 形式的字符串"""
+    for component in path:
+        if isinstance(component, int):
+            parent_path = f"{parent_path}[{component}]"
+        else:
+            parent_path = f"{parent_path}.{component}" if parent_path else component
+    return parent_path
+
+
+def _unwind_object_path(node) -> tuple:
+    """iter_object_text 遍历时的路径是 (上一级, key 或 index) 形式的嵌套元组, 根为 None,
+    追加一级不需要复制整条路径, 生成结果时再展开"""
+    components = []
+    while node is not None:
+        node, component = node
+        components.append(component)
+    components.reverse()
+    return tuple(components)
+
+
+def iter_object_text(data, filter, parent_path="", max_depth=None):
+    """用显式栈遍历 data, 逐个生成 filter 为真的字符串, 结果与 search_object_text 相同
+
+    filter 可以是函数或预编译的正则, 路径在遍历时保存为元组, 只在生成结果时拼接成字符串,
+    结果中的 path 是相对 data 的 (key, index, ...) 路径, 可以直接用于 update_object_by_path,
+    max_depth 限制进入容器的层数
+    """
+    if isinstance(filter, re.Pattern):
+        filter = filter.search
+
+    def make_result(field, text, node, is_list_item=False):
+        path = _unwind_object_path(node)
+        # 列表中的字符串没有字段名, parent_path 与 full_path 相同
+        parent = render_object_path(parent_path, path if is_list_item or not path else path[:-1])
+        return {
+            "field": field,
+            "text": text,
+            "text_hash": text_data_hash(text),
+            "parent_path": parent,
+            "full_path": parent if is_list_item or not path else render_object_path(parent, path[-1:]),
+            "path": path,
+        }
+
+    if isinstance(data, (str, bytes)):
+        if filter(data):
+            yield make_result("", data, None)
+        return
+
+    # skip spine data
+    skip_all_keys = "skeleton" in parent_path
+    # 栈中每一层保存 (路径, 深度, 子元素迭代器, 是否是 dict), 按原来递归的顺序输出
+    stack = []
+
+    def push(container, path, depth):
+        if max_depth is not None and depth > max_depth:
+            return
+        if isinstance(container, dict):
+            if skip_all_keys or not container:
+                return
+            if container.get("asset_name", "").endswith(".atlas"):
+                return
+            stack.append((path, depth, iter(container.items()), True))
+        elif isinstance(container, list):
+            stack.append((path, depth, enumerate(container), False))
+
+    push(data, None, 0)
+    while stack:
+        path, depth, items, is_dict = stack[-1]
+        for key, value in items:
+            if is_dict and "skeleton" in key:
+                continue
+            if isinstance(value, (str, bytes)):
+                if filter(value):
+                    if is_dict:
+                        yield make_result(key, value, (path, key))
+                    else:
+                        yield make_result("", value, (path, key), is_list_item=True)
+                continue
+            if isinstance(value, (dict, list)):
+                push(value, (path, key), depth + 1)
+                break
+        else:
+            stack.pop()
+
+
 def search_object_text(
     data,
     filter: callable,
@@ -134,90 +395,83 @@ def search_object_text(
     results=None,
     parent_path="",
     max_depth=None,
+    progress_bar: tqdm = None,
 ):
     if results is None:
         results = []
     if description is None:
         description = "searching for text"
 
-    progress_bar = tqdm(desc=description, total=1)
-
-    def recursive_check(data, results, parent_path):
-
-        if isinstance(data, dict):
-            for key, value in data.items():
-                current_path = f"{parent_path}.{key}" if parent_path else key
-                
-                # skip spine data
-                if "skeleton" in current_path:
-                    continue
-                if data.get("asset_name", "").endswith(".atlas"):
-                    continue
-                
-                if isinstance(value, (str, bytes)):
-                    if filter(value):
-                        results.append(
-                            {
-                                "field": key,
-                                "text": value,
-                                "text_hash": str2md5(value),
-                                "parent_path": parent_path,
-                                "full_path": current_path,
-                            }
-                        )
-                        continue
-                recursive_check(value, results, current_path)
-                progress_bar.update(1)
-        elif isinstance(data, list):
-            for index, item in enumerate(data):
-                current_path = f"{parent_path}[{index}]"
-                recursive_check(item, results, current_path)
-                progress_bar.update(1)
-        elif isinstance(data, (str, bytes)):
-            if filter(data):
-                results.append(
-                    {
-                        "field": "",
-                        "text": data,
-                        "text_hash": str2md5(data),
-                        "parent_path": parent_path,
-                        "full_path": parent_path,
-                    }
-                )
-                progress_bar.update(1)
-
-    recursive_check(data, results, parent_path)
-    progress_bar.close()
+    # 传入 progress_bar 时由调用方负责关闭
+    own_progress_bar = progress_bar is None
+    if own_progress_bar:
+        progress_bar = tqdm(desc=description)
+
+    for result in iter_object_text(data, filter, parent_path, max_depth):
+        results.append(result)
+        progress_bar.update(1)
+
+    if own_progress_bar:
+        progress_bar.close()
     return results
 
 
-def find_object_by_str_path(data, full_path):
-    path_components = full_path.lstrip(".").split(".")
-    current_obj = data
-    for component in path_components:
+def parse_object_path(full_path: str) -> tuple:
+    """把 key.list[0][1].key 形式的路径解析成 ("key", "list", 0, 1, "key")"""
+    path = []
+    for component in full_path.lstrip(".").split("."):
         if "[" in component and component.endswith("]"):
-            list_field, list_index = component.split("[")
-            list_index = int(list_index.rstrip("]"))
-            current_obj = current_obj[list_field][list_index]
+            field, *indexes = component[:-1].split("[")
+            if field:
+                path.append(field)
+            path.extend(int(index.rstrip("]")) for index in indexes)
         else:
-            current_obj = current_obj[component]
-    return current_obj
+            path.append(component)
+    return tuple(path)
+
+
+def get_text_data_path(text_data_item: dict) -> tuple:
+    """text_data.json 中文本相对 script_obj 记录的路径, 旧版本没有保存 path 时从 full_path 解析"""
+    path = text_data_item.get("path")
+    if path is not None:
+        return tuple(path)
+    # full_path 的第一段是记录本身, 例如 ClassName[0]
+    return parse_object_path(text_data_item["full_path"].split(".", 1)[1])
+
+
+def find_object_by_path(data, path):
+    for component in path:
+        data = data[component]
+    return data
+
+
+def update_object_by_path(data, path, new_value):
+    for component in path[:-1]:
+        data = data[component]
+    data[path[-1]] = new_value
+
+
+def update_objects_by_paths(data, updates):
+    """批量更新 [(path, new_value), ...], 与上一条路径相同的上级不再重复访问,
+    按 iter_object_text 的顺序传入时每个上级只访问一次"""
+    # objects[i] 是 previous[:i] 指向的对象
+    previous = ()
+    objects = [data]
+    for path, new_value in updates:
+        common = 0
+        limit = min(len(previous), len(path)) - 1
+        while common < limit and previous[common] == path[common]:
+            common += 1
+        del objects[common + 1 :]
+        for component in path[common:-1]:
+            objects.append(objects[-1][component])
+        objects[-1][path[-1]] = new_value
+        previous = path
+
+
+def find_object_by_str_path(data, full_path):
+    return find_object_by_path(data, parse_object_path(full_path))
 
 
 def update_object_by_str_path(data, full_path, new_value):
-    path_components = full_path.lstrip(".").split(".")
-    current_obj = data
-    for component in path_components[:-1]:
-        if "[" in component and component.endswith("]"):
-            list_field, list_index = component.split("[")
-            list_index = int(list_index.rstrip("]"))
-            current_obj = current_obj[list_field][list_index]
-        else:
-            current_obj = current_obj[component]
-    last_field = path_components[-1]
-    if "[" in last_field and last_field.endswith("]"):
-        list_field, list_index = last_field.split("[")
-        list_index = int(list_index.rstrip("]"))
-        current_obj[list_field][list_index] = new_value
-    else:
-        current_obj[last_field] = new_value
+    update_object_by_path(data, parse_object_path(full_path), new_value)